@@ -0,0 +1,53 @@
+'''
+Availability profiles: the timings that decide how soon the clients reach a new master after the
+old one is lost, set together so that they agree with each other.
+
+Patroni promotes a replica once the leader key of the old master expired, which takes up to ttl after
+its last update, and a replica notices that on its next loop, up to loop_wait later. Patroni needs
+loop_wait + 2 * retry_timeout to be at most ttl, so that a master which can not reach the DCS demotes
+itself before its key expires. The master load balancer sends the connections to the new master once
+HealthyThreshold checks of /master in a row succeeded on it, Interval seconds apart.
+
+The Route53 records are CNAMEs of the load balancers, which stay the same on a failover, so their TTL
+is not part of the failover time: it is how long the clients keep the addresses of the load balancer
+nodes, which change as the load balancer scales.
+'''
+
+from collections import namedtuple
+
+AvailabilityProfile = namedtuple('AvailabilityProfile', 'ttl loop_wait retry_timeout health_check_interval '
+                                                        'health_check_timeout healthy_threshold unhealthy_threshold '
+                                                        'idle_timeout dns_ttl')  # in seconds, the thresholds in checks
+
+PROMOTION_TIME = 5  # seconds from the decision of Patroni to a master accepting writes
+AVAILABILITY_PROFILES = {
+    # the defaults of Patroni and of the template before the profiles
+    'default': AvailabilityProfile(30, 10, 10, 5, 3, 2, 2, 3600, 20),
+    # the shortest timings of the load balancer health check, idle connections to a lost member time out sooner
+    'fast': AvailabilityProfile(15, 3, 6, 5, 2, 2, 2, 600, 10),
+    # tolerates longer hiccups of the DCS and the network without a failover
+    'conservative': AvailabilityProfile(60, 10, 25, 10, 5, 3, 3, 3600, 60),
+}
+DEFAULT_AVAILABILITY_PROFILE = 'default'
+
+
+def get_failover_time(profile):
+    """
+        The longest the clients of the master load balancer can be without a master when the master
+        is lost, in seconds
+
+    >>> [(name, get_failover_time(AVAILABILITY_PROFILES[name])) for name in ('default', 'fast', 'conservative')]
+    [('default', 55), ('fast', 33), ('conservative', 105)]
+    >>> all(p.loop_wait + 2 * p.retry_timeout <= p.ttl for p in AVAILABILITY_PROFILES.values())
+    True
+    """
+    return (profile.ttl + profile.loop_wait + PROMOTION_TIME +
+            profile.health_check_interval * profile.healthy_threshold)
+
+
+def get_availability(name):
+    """ The timings of the availability profile and its failover time, as a dict """
+    profile = AVAILABILITY_PROFILES[name]
+    availability = profile._asdict()
+    availability['failover_time'] = get_failover_time(profile)
+    return availability
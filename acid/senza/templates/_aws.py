@@ -0,0 +1,87 @@
+'''
+AWS clients shared by all lookups of the template.
+
+Creating a boto3 client loads the botocore service model and opens new connections, and
+creating clients from several threads off the same session is not safe. All functions of
+the template therefore get their clients from get_client(), which creates one client per
+service and region, once per process.
+'''
+
+import base64
+import threading
+
+from acid.senza.templates import _replay as replay
+from acid.senza.templates import _trace as trace
+
+AWS_MAX_POOL_CONNECTIONS = 16
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _clients_lock:
+        if _session is None:
+            import boto3
+            _session = boto3.session.Session()
+        return _session
+
+
+def get_client(service, region=None):
+    """ Client for the service in the region, shared between all callers and threads """
+    key = (service, region)
+    client = _clients.get(key)
+    if client is None:
+        from botocore.config import Config
+        session = get_session()
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = replay.wrap_client(service, region, lambda: trace.instrument_client(session.client(
+                    service, region_name=region, config=Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS))))
+                _clients[key] = client
+    return client
+
+
+def get_account_id():
+    return get_client('sts').get_caller_identity()['Account']
+
+
+def get_account_alias():
+    return get_client('iam').list_account_aliases()['AccountAliases'][0]
+
+
+def list_kms_keys(region):
+    """ List the KMS keys in the region, with their aliases and metadata """
+    kms = get_client('kms', region)
+    keys = [k for page in kms.get_paginator('list_keys').paginate() for k in page['Keys']]
+    aliases = [a for page in kms.get_paginator('list_aliases').paginate() for a in page['Aliases']]
+    for key in keys:
+        key['aliases'] = [a['AliasName'] for a in aliases if a.get('TargetKeyId') == key['KeyId']]
+        key.update(kms.describe_key(KeyId=key['KeyId'])['KeyMetadata'])
+    return keys
+
+
+def encrypt(region, key_id, plaintext):
+    """ Encrypt the plaintext with the KMS key, return the base64-encoded ciphertext """
+    encrypted = get_client('kms', region).encrypt(KeyId=key_id, Plaintext=plaintext)['CiphertextBlob']
+    return base64.b64encode(encrypted).decode('utf-8')
+
+
+def check_s3_bucket(bucket_name, region):
+    """ Create the S3 bucket if it does not exist yet """
+    from clickclick import Action
+
+    s3 = get_client('s3', region)
+    with Action("Checking S3 bucket {}..".format(bucket_name)):
+        exists = False
+        try:
+            s3.head_bucket(Bucket=bucket_name)
+            exists = True
+        except Exception:
+            pass
+    if not exists:
+        with Action("Trying to create S3 bucket {}..".format(bucket_name)):
+            s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint': region})
@@ -0,0 +1,115 @@
+'''
+Persistent cache of the discovery results, kept per AWS account and region.
+
+Most of what the template discovers in AWS and DNS changes rarely, so the results are kept
+on disk for a limited time, configured separately for each kind of result.
+'''
+
+import json
+import threading
+import time
+
+from acid.senza.templates import _trace as trace
+from acid.senza.templates._http import write_json_file
+
+MISSING = object()
+
+
+class DiscoveryCache:
+    """
+        Discovery results of one account and region, stored in a JSON file. Entries of a kind
+        expire after ttls[kind] seconds, kinds without a TTL are not cached. With refresh, the
+        stored entries are ignored, but new results are stored.
+
+    >>> import os, tempfile
+    >>> cache = DiscoveryCache(os.path.join(tempfile.mkdtemp(), 'cache.json'), {'zone': 60})
+    >>> cache.get('zone', ('example.com.',)) is MISSING
+    True
+    >>> cache.put('zone', ('example.com.',), ['10.0.0.1'])
+    >>> DiscoveryCache(cache.path, {'zone': 60}).get('zone', ('example.com.',))
+    ['10.0.0.1']
+    >>> DiscoveryCache(cache.path, {'zone': 60}, refresh=True).get('zone', ('example.com.',)) is MISSING
+    True
+    >>> cache._entries['zone'][cache._key(('example.com.',))]['expires'] = 0
+    >>> cache.put('zone', ('example.org.',), [])
+    >>> list(DiscoveryCache(cache.path, {'zone': 60})._load()['zone'])
+    ['["example.org."]']
+    >>> cache.invalidate('zone')
+    >>> DiscoveryCache(cache.path, {'zone': 60}).get('zone', ('example.org.',)) is MISSING
+    True
+    """
+
+    def __init__(self, path, ttls, refresh=False):
+        self.path = path
+        self.ttls = ttls
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(list(key), sort_keys=True)
+
+    def get(self, kind, key):
+        """ Cached value of the kind for the key, MISSING if there is no such entry or it has expired """
+        if self.refresh or not self.path or not self.ttls.get(kind):
+            return MISSING
+        with self._lock:
+            entry = self._load().get(kind, {}).get(self._key(key))
+        if not entry or entry['expires'] < time.time():
+            return MISSING
+        return entry['value']
+
+    def put(self, kind, key, value):
+        ttl = self.ttls.get(kind)
+        if not self.path or not ttl:
+            return
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            # the expired entries are dropped, so that the entries of keys that are not used again
+            # (e.g. the access keys of temporary credentials) do not pile up
+            for kind_entries in entries.values():
+                for expired in [k for k, entry in kind_entries.items() if entry['expires'] < now]:
+                    del kind_entries[expired]
+            entries.setdefault(kind, {})[self._key(key)] = {'expires': now + ttl, 'value': value}
+            try:
+                write_json_file(self.path, entries)
+            except OSError:
+                pass
+
+    def invalidate(self, kind=None):
+        """ Drop the entries of the kind, or all entries """
+        if not self.path:
+            return
+        with self._lock:
+            entries = self._load()
+            if kind is None:
+                entries.clear()
+            else:
+                entries.pop(kind, None)
+            try:
+                write_json_file(self.path, entries)
+            except OSError:
+                pass
+
+    def cached(self, kind, function, *args):
+        """ Result of function(*args), taken from the cache if possible """
+        value = self.get(kind, args)
+        if value is not MISSING:
+            trace.count('cache_hits')
+        else:
+            value = function(*args)
+            # make sure the value reads back the same as it is returned now
+            value = json.loads(json.dumps(value, default=str))
+            self.put(kind, args, value)
+        return value
@@ -0,0 +1,103 @@
+'''
+DNS lookups of the team hosts, shared by the detection of the NAT gateways and the odd hosts.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+from acid.senza.templates import _replay as replay
+from acid.senza.templates import _trace as trace
+
+DNS_TIMEOUT = 5
+DNS_NEGATIVE_TTL = 60
+DNS_MAX_WORKERS = 16
+DNS_ATTEMPTS = 3
+
+
+class DNSTimeout(Exception):
+    """ A name could not be resolved within the timeout in any of the attempts """
+
+
+class CachingResolver:
+    """
+        Resolver sending the queries for several names concurrently. Answers are cached
+        in-process for the TTL of the records, names that do not exist for DNS_NEGATIVE_TTL.
+        A query that does not complete within the timeout is retried, and raises DNSTimeout if none
+        of the attempts completes: it is neither cached nor taken for a missing name.
+    """
+
+    def __init__(self, timeout=DNS_TIMEOUT, max_workers=DNS_MAX_WORKERS, nameservers=None, port=53,
+                 attempts=DNS_ATTEMPTS):
+        self._resolver = replay.wrap_resolver(lambda: self._create_resolver(nameservers, port))
+        self._resolver.lifetime = timeout
+        self._attempts = attempts
+        self._max_workers = max_workers
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create_resolver(nameservers, port):
+        """ Resolver using the system configuration, or the given name servers """
+        import dns.resolver
+        if not nameservers:
+            return dns.resolver.Resolver()
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = list(nameservers)
+        resolver.port = port
+        return resolver
+
+    def query(self, name, rdtype='A'):
+        """ Return the list of records for a name, empty if the name does not exist """
+        import dns.exception
+        import dns.resolver
+
+        key = (name, rdtype)
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached and cached[0] > time.time():
+            trace.count('cache_hits')
+            return cached[1]
+        for attempt in range(self._attempts):
+            trace.count('dns_queries')
+            try:
+                answer = self._resolver.query(name, rdtype)
+                result = [str(rdata) for rdata in answer]
+                expiration = answer.expiration
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                result = []
+                expiration = time.time() + DNS_NEGATIVE_TTL
+            except dns.exception.Timeout:
+                continue
+            break
+        else:
+            raise DNSTimeout("Could not resolve {0} {1}: no answer within {2} seconds in {3} attempts".format(
+                name, rdtype, self._resolver.lifetime, self._attempts))
+        with self._lock:
+            self._cache[key] = (expiration, result)
+        return result
+
+    def query_all(self, names, rdtype='A'):
+        """ Query all names concurrently, return the lists of their records in the same order """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not names:
+            return []
+        unique_names = list(OrderedDict.fromkeys(names))
+        with ThreadPoolExecutor(max_workers=min(len(unique_names), self._max_workers)) as executor:
+            query = trace.bind(lambda name: self.query(name, rdtype))
+            answers = dict(zip(unique_names, executor.map(query, unique_names)))
+        return [answers[name] for name in names]
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """ The resolver shared by all lookups of the template """
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = CachingResolver()
+        return _resolver
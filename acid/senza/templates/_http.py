@@ -0,0 +1,115 @@
+'''
+HTTP requests of the template, to the Docker registry and to the AWS pricing API.
+
+All requests share one session with pooled keep-alive connections, bounded timeouts and
+retries with backoff. Responses can be revalidated with the ETag and Last-Modified of a
+previous response, so that an unchanged resource costs a single 304 round-trip.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from acid.senza.templates import _replay as replay
+from acid.senza.templates import _trace as trace
+
+HTTP_TIMEOUT = (5, 30)  # connect and read timeouts, in seconds
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            _session = requests.Session()
+            retries = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR,
+                            status_forcelist=(500, 502, 503, 504))
+            adapter = HTTPAdapter(max_retries=retries)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.headers['Accept-Encoding'] = 'gzip, deflate'
+        return _session
+
+
+def get(url, validators=None, **kwargs):
+    """
+        GET the url with the shared session. With validators of a previous response, the request
+        is conditional and the response might be 304 Not Modified.
+    """
+    headers = dict(kwargs.pop('headers', {}))
+    if validators:
+        if validators.get('ETag'):
+            headers['If-None-Match'] = validators['ETag']
+        if validators.get('Last-Modified'):
+            headers['If-Modified-Since'] = validators['Last-Modified']
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    trace.count('http_requests')
+    return replay.http_get(url, lambda: get_session().get(url, headers=headers, **kwargs))
+
+
+def get_validators(response):
+    """ Headers of the response to revalidate it with later """
+    return {name: response.headers[name] for name in ('ETag', 'Last-Modified') if name in response.headers}
+
+
+def iter_content(response, chunk_size):
+    """ Iterate over the body of a streamed response, closing it afterwards """
+    try:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            trace.count('bytes', len(chunk))
+            yield chunk
+    finally:
+        response.close()
+
+
+def get_cached_json(url, cache_dir):
+    """
+        Decoded JSON body of the url. The body is kept in the cache directory together with its
+        validators, and only downloaded again if it has changed.
+    """
+    path = os.path.join(cache_dir, 'http', hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+
+    response = get(url, cached and cached['validators'])
+    if cached and response.status_code == 304:
+        trace.count('cache_hits')
+        return cached['body']
+    response.raise_for_status()
+    trace.count('bytes', len(response.content))
+    body = response.json()
+
+    validators = get_validators(response)
+    if validators:
+        try:
+            write_json_file(path, {'validators': validators, 'body': body})
+        except OSError:
+            pass
+    return body
+
+
+def write_json_file(path, data):
+    """ Replace the file at path atomically with the JSON-encoded data """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
@@ -0,0 +1,408 @@
+'''
+Lookups in the AWS EC2 pricing offer file.
+
+The offer file is a single JSON document of several hundred megabytes. Instead of decoding
+it at once, it is scanned incrementally and only the members we are interested in are decoded.
+The prices of all instances can be written to a compact local index for repeated lookups.
+'''
+
+import codecs
+import json
+import mmap
+import os
+import re
+import tempfile
+import time
+
+_decoder = json.JSONDecoder()
+_non_whitespace = re.compile(r'[^ \t\n\r]')
+# a string, with the closing quote in the group unless the buffer ends first, or a bracket
+_skip_token = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*("?)|[][{}]', re.DOTALL)
+_number_tail = re.compile(r'[0-9.eE+-]*')
+_index_attributes = ('location', 'instanceType', 'operatingSystem', 'tenancy')
+
+
+class JSONStream:
+    """
+        Incremental reader of a JSON document supplied as an iterable of chunks.
+
+        Objects are walked member by member with members(), individual values are
+        decoded with value() and skipped with skip(). Only the value currently being
+        decoded is kept in memory, together with at most one unconsumed chunk. Skipped
+        objects, arrays and strings are only scanned for their end, not decoded.
+
+    >>> stream = JSONStream(['{"a": 1, "b"', ': {"c": [1, 2], "d": "e"}, "f": 12', '3}'])
+    >>> for key in stream.members():
+    ...     if key == 'b':
+    ...         [(k, stream.value()) for k in stream.members()]
+    ...     elif key == 'f':
+    ...         stream.value()
+    [('c', [1, 2]), ('d', 'e')]
+    123
+    >>> stream = JSONStream(['{"a": {"b": [1, {"c": "}\\\\', '"]"}], "d', '": {}}, "e": 2}'])
+    >>> [(key, stream.value()) for key in stream.members() if key == 'e']
+    [('e', 2)]
+    """
+
+    def __init__(self, chunks, encoding='utf-8'):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder(encoding)()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._consumed = 0
+
+    def _fill(self):
+        """ Append the next chunk to the buffer, return False at the end of the document """
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._text_decoder.decode(chunk)
+            if chunk:
+                self._append(chunk)
+                return True
+        self._eof = True
+        tail = self._text_decoder.decode(b'', final=True)
+        if tail:
+            self._append(tail)
+        return bool(tail)
+
+    def _append(self, text):
+        # drop the part of the buffer that has been consumed already
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+
+    def _peek(self):
+        while True:
+            match = _non_whitespace.search(self._buf, self._pos)
+            if match:
+                self._pos = match.start()
+                return self._buf[self._pos]
+            self._pos = len(self._buf)
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError("Expected one of '{0}' in the JSON document, got '{1}'".format(chars, c))
+        self._pos += 1
+        return c
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number followed by nothing but what could be more of it might continue in the next chunk
+            if not _number_tail.fullmatch(self._buf, end) or not self._fill():
+                self._pos = end
+                return value
+
+    def value(self):
+        """ Decode the next value in the document """
+        self._consumed += 1
+        return self._decode()
+
+    def skip(self):
+        """ Skip the next value in the document """
+        if self._peek() not in ('{', '[', '"'):
+            # numbers and literals are short
+            self._decode()
+            return
+        depth = 0
+        while True:
+            for match in _skip_token.finditer(self._buf, self._pos):
+                token = match.group()
+                if token[0] == '"':
+                    if not match.group(1):
+                        # read the string again once the rest of it is in the buffer
+                        self._pos = match.start()
+                        break
+                elif token in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                if depth == 0:
+                    self._pos = match.end()
+                    return
+            else:
+                self._pos = len(self._buf)
+            self._need_more()
+
+    def _need_more(self):
+        if not self._fill():
+            raise ValueError('Unexpected end of the JSON document')
+
+    def members(self):
+        """
+            Iterate over the keys of the object at the current position. After each key the
+            caller may consume its value with value(), skip() or members(); values left
+            untouched are skipped automatically.
+        """
+        self._consumed += 1
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            consumed = self._consumed
+            yield key
+            if consumed == self._consumed:
+                self.skip()
+            if self._expect(',}') == '}':
+                return
+
+
+def product_matches(product, location, instance_type, operating_system='Linux', tenancy='Shared'):
+    """
+    >>> product_matches({'productFamily': 'Compute Instance', 'attributes': {'location': 'EU (Ireland)',
+    ...                  'instanceType': 'm4.large', 'operatingSystem': 'Linux', 'tenancy': 'Shared'}},
+    ...                 'EU (Ireland)', 'm4.large')
+    True
+    >>> product_matches({'productFamily': 'Storage', 'attributes': {}}, 'EU (Ireland)', 'm4.large')
+    False
+    """
+    attributes = product.get('attributes', {})
+    return (product.get('productFamily') == 'Compute Instance' and
+            attributes.get('location') == location and
+            attributes.get('instanceType') == instance_type and
+            attributes.get('operatingSystem') == operating_system and
+            attributes.get('tenancy') == tenancy)
+
+
+def find_on_demand_offer(chunks, location, instance_type):
+    """
+        Scan the offer file for the SKU of the on-demand Linux instance of a given type in
+        a given location, and for the on-demand terms of that SKU. Returns a tuple (sku, terms),
+        with None in place of whatever could not be found. The scan stops as soon as the terms
+        of the SKU are read, relying on 'products' preceding 'terms' in the offer file.
+
+    >>> find_on_demand_offer([b'{"products": {"X": {"sku": "X", "productFamily": "Compute Instance", "attri',
+    ...     b'butes": {"location": "L", "instanceType": "t2.micro", "operatingSystem": "Linux", "tenancy":',
+    ...     b' "Shared"}}}, "terms": {"OnDemand": {"Y": {}, "X": {"X.1": {"priceDimensions": {}}}}}}'],
+    ...     'L', 't2.micro')
+    ('X', {'X.1': {'priceDimensions': {}}})
+    """
+    stream = JSONStream(chunks)
+    sku = None
+    for key in stream.members():
+        if key == 'products':
+            for _ in stream.members():
+                product = stream.value()
+                if sku is None and product_matches(product, location, instance_type):
+                    sku = product['sku']
+        elif key == 'terms':
+            if sku is None:
+                break
+            for term_type in stream.members():
+                if term_type == 'OnDemand':
+                    for term_sku in stream.members():
+                        if term_sku == sku:
+                            return sku, stream.value()
+                    break
+            break
+    return sku, None
+
+
+def on_demand_unit_price(terms):
+    """
+        Extract the hourly USD price from the on-demand terms of a single SKU, None if the terms
+        do not describe exactly one price.
+
+    >>> on_demand_unit_price({'X.1': {'priceDimensions': {'X.1.2': {'pricePerUnit': {'USD': '0.15'}}}}})
+    0.15
+    >>> on_demand_unit_price({'X.1': {}, 'X.2': {}}) is None
+    True
+    """
+    if len(terms) != 1:
+        return None
+    dimensions = next(iter(terms.values())).get('priceDimensions', {})
+    if len(dimensions) != 1:
+        return None
+    price = next(iter(dimensions.values())).get('pricePerUnit', {}).get('USD')
+    return float(price) if price is not None else None
+
+
+def build_price_index(chunks, path):
+    """
+        Scan the complete offer file and write the on-demand price of every compute instance to
+        path, one line per (location, instance type, operating system, tenancy) sorted by those
+        fields. When several SKUs share the same fields, the first one is used, same as in
+        find_on_demand_offer. The file is replaced atomically. Returns the number of entries written.
+    """
+    stream = JSONStream(chunks)
+    keys = {}
+    skus = {}
+    prices = {}
+    for key in stream.members():
+        if key == 'products':
+            for _ in stream.members():
+                product = stream.value()
+                if product.get('productFamily') != 'Compute Instance':
+                    continue
+                attributes = product.get('attributes', {})
+                fields = tuple(attributes.get(a) for a in _index_attributes)
+                if all(isinstance(f, str) and '\t' not in f and '\n' not in f for f in fields) and fields not in keys:
+                    keys[fields] = product['sku']
+                    skus[product['sku']] = fields
+        elif key == 'terms':
+            for term_type in stream.members():
+                if term_type == 'OnDemand':
+                    for sku in stream.members():
+                        if sku in skus:
+                            price = on_demand_unit_price(stream.value())
+                            if price is not None:
+                                prices[skus[sku]] = price
+                    break
+            break
+    if not prices:
+        raise ValueError('No on-demand prices found in the offer file')
+
+    lines = sorted('\t'.join(fields + (repr(price),)) + '\n' for fields, price in prices.items())
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.prices')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(''.join(lines).encode('utf-8'))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return len(lines)
+
+
+class PriceIndex:
+    """
+        Read-only view of a price index written by build_price_index. The file is memory-mapped
+        and searched with bisection, so a lookup only touches a handful of pages.
+
+    >>> import tempfile
+    >>> entries = [('A', 'L1', 'm4.large', 'Linux', '0.1'), ('B', 'L1', 'm4.large', 'Windows', '0.2'),
+    ...            ('C', 'L1', 'm4.xlarge', 'Linux', '0.3'), ('D', 'L10', 'm4.large', 'Linux', '0.4'),
+    ...            ('E', 'L2', 't2.micro', 'Linux', '0.01')]
+    >>> offer = {'products': {sku: {'sku': sku, 'productFamily': 'Compute Instance', 'attributes': {
+    ...              'location': location, 'instanceType': instance_type, 'operatingSystem': system,
+    ...              'tenancy': 'Shared'}} for sku, location, instance_type, system, _ in entries},
+    ...          'terms': {'OnDemand': {sku: {'T': {'priceDimensions': {'P': {'pricePerUnit': {'USD': price}}}}}
+    ...                                 for sku, _, _, _, price in entries}}}
+    >>> path = os.path.join(tempfile.mkdtemp(), 'prices')
+    >>> build_price_index([json.dumps(offer)], path)
+    5
+    >>> index = PriceIndex(path)
+    >>> index.lookup('L1', 'm4.large'), index.lookup('L1', 'm4.large', 'Windows'), index.lookup('L2', 't2.micro')
+    (0.1, 0.2, 0.01)
+    >>> index.lookup('L1', 'm4'), index.lookup('L', 'm4.large'), index.lookup('L3', 'm4.large')
+    (None, None, None)
+    >>> sorted(index.prices('L1').items()), index.prices('L10'), index.prices('L3')
+    ([('m4.large', 0.1), ('m4.xlarge', 0.3)], {'m4.large': 0.4}, {})
+    >>> index.close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._lookups = {}
+
+    def close(self):
+        self._map.close()
+
+    def _lower_bound(self, key):
+        """ Offset of the first line not less than key """
+        lo, hi = 0, len(self._map)
+        while lo < hi:
+            start = self._map.rfind(b'\n', 0, (lo + hi) // 2) + 1
+            end = self._map.find(b'\n', start)
+            if self._map[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def _lines(self, prefix):
+        """ Fields of the consecutive lines starting with prefix """
+        key = '\t'.join(prefix).encode('utf-8') + b'\t'
+        pos = self._lower_bound(key)
+        while pos < len(self._map):
+            end = self._map.find(b'\n', pos)
+            line = self._map[pos:end]
+            if not line.startswith(key):
+                break
+            yield line.decode('utf-8').split('\t')
+            pos = end + 1
+
+    def lookup(self, location, instance_type, operating_system='Linux', tenancy='Shared'):
+        """ Hourly on-demand price in USD, None if the index has no such entry """
+        key = (location, instance_type, operating_system, tenancy)
+        if key not in self._lookups:
+            self._lookups[key] = next((float(fields[-1]) for fields in self._lines(key)), None)
+        return self._lookups[key]
+
+    def prices(self, location, operating_system='Linux', tenancy='Shared'):
+        """ Dictionary of the hourly on-demand prices of all instance types available in a location """
+        return {fields[1]: float(fields[-1]) for fields in self._lines((location,))
+                if fields[2] == operating_system and fields[3] == tenancy}
+
+
+def load_price_index(path, ttl, fetch):
+    """
+        Open the price index at path, building it first if it does not exist or is older than ttl
+        seconds. fetch(validators) should return the chunks of the offer file together with its
+        validators (ETag and Last-Modified), or None if the offer file has not changed since the
+        one with the validators passed, in which case the existing index is kept for another ttl.
+        When rebuilding an expired index fails, the expired one is used instead.
+
+    >>> import tempfile
+    >>> offer = ('{"products": {"A": {"sku": "A", "productFamily": "Compute Instance", "attributes": {"location": '
+    ...          '"L", "instanceType": "m4.large", "operatingSystem": "Linux", "tenancy": "Shared"}}}, "terms": '
+    ...          '{"OnDemand": {"A": {"T": {"priceDimensions": {"P": {"pricePerUnit": {"USD": "0.1"}}}}}}}}')
+    >>> path = os.path.join(tempfile.mkdtemp(), 'prices')
+    >>> def fail(validators):
+    ...     raise OSError('offline')
+    >>> load_price_index(path, 60, fail)
+    Traceback (most recent call last):
+    ...
+    OSError: offline
+    >>> load_price_index(path, 60, lambda validators: ([offer], {'ETag': '"1"'})).lookup('L', 'm4.large')
+    0.1
+    >>> os.utime(path, (0, 0))
+    >>> load_price_index(path, 60, fail).lookup('L', 'm4.large'), os.path.getmtime(path)
+    (0.1, 0.0)
+    >>> load_price_index(path, 60, lambda validators: print(validators)).lookup('L', 'm4.large')
+    {'ETag': '"1"'}
+    0.1
+    >>> time.time() - os.path.getmtime(path) < 60
+    True
+    """
+    validators_path = path + '.validators'
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        age = None
+    if age is None or age > ttl:
+        try:
+            validators = None
+            if age is not None and os.path.exists(validators_path):
+                with open(validators_path) as f:
+                    validators = json.load(f)
+            fetched = fetch(validators)
+            if fetched is None:
+                os.utime(path)
+            else:
+                chunks, validators = fetched
+                build_price_index(chunks, path)
+                with open(validators_path, 'w') as f:
+                    json.dump(validators, f)
+        except Exception:
+            if age is None:
+                raise
+    return PriceIndex(path)
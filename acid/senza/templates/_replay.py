@@ -0,0 +1,311 @@
+'''
+Record and replay of the external calls of the template: AWS API calls, DNS queries and HTTP requests.
+
+With SPILO_RECORD=<file>, every response, or the exception raised instead, is saved to the snapshot
+file together with the time it took. With SPILO_REPLAY=<file>, the saved responses are served without
+any network access, optionally delayed by the recorded latency multiplied by SPILO_REPLAY_LATENCY
+(default: 0, no delay). Calls with the same arguments are replayed in the order they were recorded,
+the last response repeating once all have been served.
+
+HTTP responses are matched by their URL only, and are read completely while recording.
+'''
+
+import atexit
+import base64
+import datetime
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+SNAPSHOT_VERSION = 1
+# parameters that differ on every run and are left out of the keys of the recorded calls
+VOLATILE_PARAMETERS = ('Plaintext',)
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_snapshot_configured = False
+
+
+class ReplayError(Exception):
+    pass
+
+
+def encode(value):
+    """
+        JSON-compatible copy of an API response, with the bytes and timestamps tagged
+
+    >>> encode({'Blob': b'\\x00', 'Date': datetime.datetime(2017, 1, 1)})
+    {'Blob': {'__bytes__': 'AA=='}, 'Date': {'__datetime__': '2017-01-01T00:00:00'}}
+    >>> decode(encode({'Blob': b'\\x00', 'Date': datetime.datetime(2017, 1, 1)}))['Date'].year
+    2017
+    """
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict):
+        if '__bytes__' in value:
+            return base64.b64decode(value['__bytes__'])
+        if '__datetime__' in value:
+            text = value['__datetime__']
+            for fmt in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+                try:
+                    return datetime.datetime.strptime(text, fmt)
+                except ValueError:
+                    pass
+        return {k: decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+
+def encode_exception(e):
+    cls = type(e)
+    error = {'type': '{0}.{1}'.format(cls.__module__, cls.__name__)}
+    if hasattr(e, 'response') and hasattr(e, 'operation_name'):
+        # botocore.exceptions.ClientError and its subclasses
+        error.update(response=encode(e.response), operation_name=e.operation_name)
+    else:
+        error['args'] = [a if isinstance(a, (str, int, float)) else str(a) for a in e.args]
+    return error
+
+
+def decode_exception(error):
+    module, _, name = error['type'].rpartition('.')
+    try:
+        cls = getattr(importlib.import_module(module), name)
+        if 'operation_name' in error:
+            return cls(decode(error['response']), error['operation_name'])
+        return cls(*error['args'])
+    except (ImportError, AttributeError, TypeError):
+        return ReplayError('{0}: {1}'.format(error['type'], ', '.join(map(str, error.get('args', [])))))
+
+
+class Snapshot:
+    """
+        Recorded calls, keyed by the kind of the call and its arguments. In record mode call() runs
+        the function and saves its result, in replay mode it returns the saved result instead.
+
+    >>> snapshot = Snapshot(None, 'record')
+    >>> snapshot.call(['dns', 'example.com.', 'A'], lambda: ['10.0.0.1'])
+    ['10.0.0.1']
+    >>> Snapshot(None, 'replay', snapshot.calls).call(['dns', 'example.com.', 'A'], None)
+    ['10.0.0.1']
+    >>> try:
+    ...     Snapshot(None, 'replay', snapshot.calls).call(['dns', 'example.org.', 'A'], None)
+    ... except ReplayError as e:
+    ...     print(e)
+    No recorded response for ["dns", "example.org.", "A"]
+    """
+
+    def __init__(self, path, mode, calls=None, latency=0):
+        self.path = path
+        self.mode = mode
+        self.calls = calls if calls is not None else {}
+        self.latency = latency
+        self._served = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, latency=0):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise ReplayError('Unsupported snapshot version {0} in {1}'.format(data.get('version'), path))
+        return cls(path, 'replay', data['calls'], latency)
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                with self._lock:
+                    json.dump({'version': SNAPSHOT_VERSION, 'calls': self.calls}, f)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def call(self, key, function):
+        """ Result of function(), recorded or replayed for the key """
+        key = json.dumps(key, sort_keys=True, default=str)
+        if self.mode == 'replay':
+            return self._replay(key)
+
+        started = time.time()
+        try:
+            entry = {'result': encode(function())}
+        except Exception as e:
+            entry = {'error': encode_exception(e)}
+            raise
+        finally:
+            entry['elapsed'] = time.time() - started
+            with self._lock:
+                self.calls.setdefault(key, []).append(entry)
+        return decode(entry['result'])
+
+    def _replay(self, key):
+        with self._lock:
+            entries = self.calls.get(key)
+            if not entries:
+                raise ReplayError('No recorded response for {0}'.format(key))
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        entry = entries[min(served, len(entries) - 1)]
+        if self.latency:
+            time.sleep(entry['elapsed'] * self.latency)
+        if 'error' in entry:
+            raise decode_exception(entry['error'])
+        return decode(entry['result'])
+
+
+class RecordedClient:
+    """ Boto3 client proxy with all API calls, including the paginated ones, going through the snapshot """
+
+    def __init__(self, snapshot, service, region, factory):
+        self._snapshot = snapshot
+        self._service = service
+        self._region = region
+        self._factory = factory
+        self._client = None
+
+    @property
+    def client(self):
+        # only created when recording, replay does not need credentials or a network
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+    def _key(self, operation, args, kwargs):
+        kwargs = {k: v for k, v in kwargs.items() if k not in VOLATILE_PARAMETERS}
+        return ['aws', self._service, self._region, operation, args, kwargs]
+
+    def get_paginator(self, operation):
+        return RecordedPaginator(self, operation)
+
+    def __getattr__(self, operation):
+        def call(*args, **kwargs):
+            return self._snapshot.call(self._key(operation, args, kwargs),
+                                       lambda: getattr(self.client, operation)(*args, **kwargs))
+        return call
+
+
+class RecordedPaginator:
+
+    def __init__(self, client, operation):
+        self._client = client
+        self._operation = operation
+
+    def paginate(self, **kwargs):
+        client = self._client
+        return client._snapshot.call(client._key('paginate:' + self._operation, (), kwargs),
+                                     lambda: list(client.client.get_paginator(self._operation).paginate(**kwargs)))
+
+
+class RecordedAnswer(list):
+    """ Records of a DNS answer, with the absolute expiration time as in dns.resolver.Answer """
+
+    def __init__(self, records, expiration):
+        super().__init__(records)
+        self.expiration = expiration
+
+
+class RecordedResolver:
+    """ dns.resolver.Resolver proxy returning the recorded answers, with their TTLs, as RecordedAnswer """
+
+    def __init__(self, snapshot, factory):
+        self._snapshot = snapshot
+        self._factory = factory
+        self._resolver = None
+        self.lifetime = None
+
+    def _query(self, name, rdtype):
+        if self._resolver is None:
+            self._resolver = self._factory()
+            if self.lifetime is not None:
+                self._resolver.lifetime = self.lifetime
+        answer = self._resolver.query(name, rdtype)
+        return {'records': [str(rdata) for rdata in answer], 'ttl': answer.expiration - time.time()}
+
+    def query(self, name, rdtype='A'):
+        answer = self._snapshot.call(['dns', name, rdtype], lambda: self._query(name, rdtype))
+        return RecordedAnswer(answer['records'], time.time() + answer['ttl'])
+
+
+def http_response(recorded, url):
+    """ requests.Response with the recorded status, headers and the complete body """
+    import requests
+    from requests.structures import CaseInsensitiveDict
+
+    response = requests.Response()
+    response.url = url
+    response.status_code = recorded['status_code']
+    response.reason = recorded['reason']
+    response.headers = CaseInsensitiveDict(recorded['headers'])
+    response._content = recorded['content']
+    response._content_consumed = True
+    return response
+
+
+def record_http(function):
+    response = function()
+    content = response.content
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in ('content-encoding', 'content-length')}
+    return {'status_code': response.status_code, 'reason': response.reason, 'headers': headers, 'content': content}
+
+
+def get_snapshot():
+    """ Snapshot of the process, configured with SPILO_RECORD or SPILO_REPLAY, None if neither is set """
+    global _snapshot, _snapshot_configured
+    with _snapshot_lock:
+        if not _snapshot_configured:
+            _snapshot_configured = True
+            if os.environ.get('SPILO_REPLAY'):
+                _snapshot = Snapshot.load(os.environ['SPILO_REPLAY'], float(os.environ.get('SPILO_REPLAY_LATENCY', 0)))
+            elif os.environ.get('SPILO_RECORD'):
+                _snapshot = Snapshot(os.environ['SPILO_RECORD'], 'record')
+                atexit.register(_snapshot.save)
+        return _snapshot
+
+
+def set_snapshot(snapshot):
+    """ Use the snapshot for all following calls instead of the one configured in the environment """
+    global _snapshot, _snapshot_configured
+    with _snapshot_lock:
+        _snapshot = snapshot
+        _snapshot_configured = True
+
+
+def wrap_client(service, region, factory):
+    """ Client created by the factory, or its recorded stand-in """
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return factory()
+    return RecordedClient(snapshot, service, region, factory)
+
+
+def wrap_resolver(factory):
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return factory()
+    return RecordedResolver(snapshot, factory)
+
+
+def http_get(url, function):
+    """ Response of function(), the GET request of the url, or its recorded stand-in """
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return function()
+    return http_response(snapshot.call(['http', 'GET', url], lambda: record_http(function)), url)
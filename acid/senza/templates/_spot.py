@@ -0,0 +1,176 @@
+'''
+Analysis of the spot price history of EC2 instance types, to bid for spot instances.
+
+The history is streamed page by page from describe_spot_price_history into columns backed by
+arrays: the time, the price and the series (availability zone and product) of every price change,
+a few bytes per record instead of a dict each, so that months of history of many instance types
+fit in memory. The statistics of a series are computed over its whole columns at once, every
+price weighted by how long it was in effect.
+'''
+
+import bisect
+import calendar
+import math
+import operator
+from array import array
+from collections import namedtuple
+from itertools import accumulate, compress, repeat
+
+PRODUCT_DESCRIPTIONS = ('Linux/UNIX', 'Linux/UNIX (Amazon VPC)')
+PAGE_SIZE = 1000
+SECONDS_PER_DAY = 86400
+
+SeriesStatistics = namedtuple('SeriesStatistics', 'zone product mean volatility percentile maximum '
+                                                  'interruption_risk interruptions_per_day')
+SpotAnalysis = namedtuple('SpotAnalysis', 'bid series')
+
+
+class SpotPriceHistory:
+    """
+        Price changes of an instance type in the availability zones of a region, as columns
+
+    >>> history = SpotPriceHistory()
+    >>> history.extend([('eu-west-1a', 'Linux/UNIX', 3600, 0.3), ('eu-west-1b', 'Linux/UNIX', 0, 0.2),
+    ...                 ('eu-west-1a', 'Linux/UNIX', 0, 0.1)])
+    >>> [(zone, list(times), list(prices)) for (zone, _), times, prices in history.series()]
+    [('eu-west-1a', [0.0, 3600.0], [0.1, 0.3]), ('eu-west-1b', [0.0], [0.2])]
+    """
+
+    def __init__(self):
+        self.keys = []  # (zone, product) of each series
+        self.times = array('d')
+        self.prices = array('d')
+        self.series_ids = array('H')
+        self._series_ids = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, zone, product, time, price):
+        key = (zone, product)
+        series_id = self._series_ids.get(key)
+        if series_id is None:
+            series_id = self._series_ids[key] = len(self.keys)
+            self.keys.append(key)
+        self.series_ids.append(series_id)
+        self.times.append(time)
+        self.prices.append(price)
+
+    def extend(self, records):
+        for record in records:
+            self.append(*record)
+
+    def series(self):
+        """ The key, times and prices of every series, in the order of time """
+        times = self.times
+        order = sorted(range(len(times)), key=list(zip(self.series_ids, times)).__getitem__)
+        series_ids = array('H', map(self.series_ids.__getitem__, order))
+        for series_id in sorted(set(series_ids)):
+            start, end = bisect.bisect_left(series_ids, series_id), bisect.bisect_right(series_ids, series_id)
+            indexes = order[start:end]
+            yield self.keys[series_id], array('d', map(times.__getitem__, indexes)), \
+                array('d', map(self.prices.__getitem__, indexes))
+
+
+def get_durations(times, start, end):
+    """
+        How long each price of a series was in effect between start and end. The first record
+        of the history may be older than start, as it is the price in effect at that time.
+
+    >>> list(get_durations(array('d', [50, 120, 150]), 100, 200))
+    [20.0, 30.0, 50.0]
+    """
+    starts = array('d', map(max, times, repeat(start)))
+    ends = starts[1:]
+    ends.append(max(end, starts[-1]))
+    return array('d', map(operator.sub, ends, starts))
+
+
+def weighted_percentile(prices, weights, percentile):
+    """
+        The lowest price that was in effect at least percentile % of the time
+
+    >>> weighted_percentile([0.1, 0.3, 0.2], [1, 1, 2], 50)
+    0.2
+    >>> weighted_percentile([0.1, 0.3, 0.2], [1, 1, 2], 100)
+    0.3
+    """
+    order = sorted(range(len(prices)), key=prices.__getitem__)
+    cumulative = list(accumulate(map(weights.__getitem__, order)))
+    position = bisect.bisect_left(cumulative, cumulative[-1] * percentile / 100.0)
+    return prices[order[min(position, len(order) - 1)]]
+
+
+def analyze_spot_prices(history, start, end, percentile, maximum_bid=None):
+    """
+        Statistics of every series of the history between start and end (in seconds since the epoch),
+        and the bid: the highest of the percentiles of the series, as the instances of the cluster may
+        run in any of the zones, capped at maximum_bid. None if there is no history.
+
+        The interruption risk is the fraction of the time the price was above the bid, and the
+        interruptions the number of times it went above the bid.
+
+    >>> history = SpotPriceHistory()
+    >>> history.extend([('a', 'Linux/UNIX', 0, 0.1), ('a', 'Linux/UNIX', 43200, 0.3), ('a', 'Linux/UNIX', 64800, 0.1),
+    ...                 ('b', 'Linux/UNIX', 0, 0.2)])
+    >>> analysis = analyze_spot_prices(history, 0, 86400, 75)
+    >>> analysis.bid, [(s.zone, round(s.mean, 3), s.interruption_risk) for s in analysis.series]
+    (0.2, [('a', 0.15, 0.25), ('b', 0.2, 0.0)])
+    """
+    if not len(history):
+        return SpotAnalysis(None, [])
+    series = []
+    for (zone, product), times, prices in history.series():
+        weights = get_durations(times, start, end)
+        total = sum(weights)
+        if not total:
+            weights, total = array('d', repeat(1.0, len(prices))), float(len(prices))
+        mean = sum(map(operator.mul, prices, weights)) / total
+        deviations = array('d', map(operator.sub, prices, repeat(mean)))
+        variance = sum(map(operator.mul, map(operator.mul, deviations, deviations), weights)) / total
+        series.append((zone, product, prices, weights, total, mean, math.sqrt(variance) / mean if mean else 0.0,
+                       weighted_percentile(prices, weights, percentile)))
+
+    bid = max(s[-1] for s in series)
+    if maximum_bid is not None:
+        bid = min(bid, maximum_bid)
+    days = max(end - start, 1) / SECONDS_PER_DAY
+    statistics = []
+    for zone, product, prices, weights, total, mean, volatility, zone_percentile in series:
+        above = list(map(operator.gt, prices, repeat(bid)))
+        risk = sum(compress(weights, above)) / total
+        interruptions = sum(map(operator.lt, above[:-1], above[1:]))
+        statistics.append(SeriesStatistics(zone, product, mean, volatility, zone_percentile,
+                                           max(compress(prices, weights), default=bid), risk, interruptions / days))
+    return SpotAnalysis(bid, statistics)
+
+
+def to_timestamp(value):
+    """
+        Seconds since the epoch of the datetime, naive ones are taken as UTC
+
+    >>> from datetime import datetime, timezone
+    >>> to_timestamp(datetime(1970, 1, 2)), to_timestamp(datetime(1970, 1, 2, tzinfo=timezone.utc))
+    (86400.0, 86400.0)
+    """
+    if value.tzinfo is not None:
+        return value.timestamp()
+    return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+
+
+def load_spot_price_history(ec2, instance_types, start, end):
+    """
+        SpotPriceHistory of each of the instance types between the start and end datetimes, fetched
+        for all of them at once and loaded page by page.
+    """
+    histories = {instance_type: SpotPriceHistory() for instance_type in instance_types}
+    pages = ec2.get_paginator('describe_spot_price_history').paginate(
+        InstanceTypes=sorted(histories), ProductDescriptions=list(PRODUCT_DESCRIPTIONS),
+        StartTime=start, EndTime=end, PaginationConfig={'PageSize': PAGE_SIZE})
+    for page in pages:
+        for record in page['SpotPriceHistory']:
+            history = histories.get(record['InstanceType'])
+            if history is not None:
+                history.append(record['AvailabilityZone'], record['ProductDescription'],
+                               to_timestamp(record['Timestamp']), float(record['SpotPrice']))
+    return histories
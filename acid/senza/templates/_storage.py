@@ -0,0 +1,158 @@
+'''
+Layout of the storage of the data directory: the block devices of the instance, either EBS volumes
+or the instance store, the RAID0 array Taupage assembles from them when there is more than one,
+and the throughput the volumes and the instance can do.
+
+The performance of the EBS volumes is the baseline of the volume type, the limits of the instance
+are the ones of its dedicated EBS bandwidth, per
+http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/EBSVolumeTypes.html and
+http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/EBSOptimized.html
+'''
+
+from collections import namedtuple
+
+Performance = namedtuple('Performance', 'iops throughput')  # throughput in MB/s
+# the device name in the block device mapping and the one the OS sees, they differ for NVMe devices
+BlockDevice = namedtuple('BlockDevice', 'device partition volume_size volume_iops virtual_name')
+InstanceStore = namedtuple('InstanceStore', 'count size kind')  # size of each device in GB
+
+RAID_DEVICE = '/dev/md/pgdata'
+DEVICE_LETTERS = 'klmnopqrstuvwxyz'
+EPHEMERAL_DEVICE_LETTERS = 'bcdefghijklmnopqrstuvwxy'
+MAX_VOLUMES = len(DEVICE_LETTERS)
+IO1_IOPS_PER_GB = 30
+
+# instance type: dedicated EBS bandwidth in Mbps, maximum IOPS
+EBS_LIMITS = {
+    'm3.xlarge': (500, 4000), 'm3.2xlarge': (1000, 8000),
+    'm4.large': (450, 3600), 'm4.xlarge': (750, 6000), 'm4.2xlarge': (1000, 8000), 'm4.4xlarge': (2000, 16000),
+    'm4.10xlarge': (4000, 32000), 'm4.16xlarge': (10000, 65000),
+    'c3.xlarge': (500, 4000), 'c3.2xlarge': (1000, 8000), 'c3.4xlarge': (2000, 16000),
+    'c4.large': (500, 4000), 'c4.xlarge': (750, 6000), 'c4.2xlarge': (1000, 8000), 'c4.4xlarge': (2000, 16000),
+    'c4.8xlarge': (4000, 32000),
+    'r3.xlarge': (500, 4000), 'r3.2xlarge': (1000, 8000), 'r3.4xlarge': (2000, 16000),
+    'r4.large': (425, 3000), 'r4.xlarge': (850, 6000), 'r4.2xlarge': (1700, 12000), 'r4.4xlarge': (3500, 18750),
+    'r4.8xlarge': (7000, 37500), 'r4.16xlarge': (14000, 75000),
+    'i2.xlarge': (500, 4000), 'i2.2xlarge': (1000, 8000), 'i2.4xlarge': (2000, 16000),
+    'i3.large': (425, 3000), 'i3.xlarge': (850, 6000), 'i3.2xlarge': (1700, 12000), 'i3.4xlarge': (3500, 16000),
+    'i3.8xlarge': (7000, 32500), 'i3.16xlarge': (14000, 65000),
+    'd2.xlarge': (750, 6000), 'd2.2xlarge': (1000, 8000), 'd2.4xlarge': (2000, 16000), 'd2.8xlarge': (4000, 32000),
+    'x1.16xlarge': (5000, 40000), 'x1.32xlarge': (10000, 80000),
+}
+
+# per http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/InstanceStorage.html
+INSTANCE_STORES = {
+    'm3.medium': InstanceStore(1, 4, 'ssd'), 'm3.large': InstanceStore(1, 32, 'ssd'),
+    'm3.xlarge': InstanceStore(2, 40, 'ssd'), 'm3.2xlarge': InstanceStore(2, 80, 'ssd'),
+    'c3.large': InstanceStore(2, 16, 'ssd'), 'c3.xlarge': InstanceStore(2, 40, 'ssd'),
+    'c3.2xlarge': InstanceStore(2, 80, 'ssd'), 'c3.4xlarge': InstanceStore(2, 160, 'ssd'),
+    'c3.8xlarge': InstanceStore(2, 320, 'ssd'),
+    'r3.large': InstanceStore(1, 32, 'ssd'), 'r3.xlarge': InstanceStore(1, 80, 'ssd'),
+    'r3.2xlarge': InstanceStore(1, 160, 'ssd'), 'r3.4xlarge': InstanceStore(1, 320, 'ssd'),
+    'r3.8xlarge': InstanceStore(2, 320, 'ssd'),
+    'i2.xlarge': InstanceStore(1, 800, 'ssd'), 'i2.2xlarge': InstanceStore(2, 800, 'ssd'),
+    'i2.4xlarge': InstanceStore(4, 800, 'ssd'), 'i2.8xlarge': InstanceStore(8, 800, 'ssd'),
+    'i3.large': InstanceStore(1, 475, 'nvme'), 'i3.xlarge': InstanceStore(1, 950, 'nvme'),
+    'i3.2xlarge': InstanceStore(1, 1900, 'nvme'), 'i3.4xlarge': InstanceStore(2, 1900, 'nvme'),
+    'i3.8xlarge': InstanceStore(4, 1900, 'nvme'), 'i3.16xlarge': InstanceStore(8, 1900, 'nvme'),
+    'd2.xlarge': InstanceStore(3, 2000, 'hdd'), 'd2.2xlarge': InstanceStore(6, 2000, 'hdd'),
+    'd2.4xlarge': InstanceStore(12, 2000, 'hdd'), 'd2.8xlarge': InstanceStore(24, 2000, 'hdd'),
+    'x1.16xlarge': InstanceStore(1, 1920, 'ssd'), 'x1.32xlarge': InstanceStore(2, 1920, 'ssd'),
+}
+
+
+def get_device_names(count, letters=DEVICE_LETTERS):
+    """
+    >>> get_device_names(3)
+    ['/dev/xvdk', '/dev/xvdl', '/dev/xvdm']
+    """
+    return ['/dev/xvd' + letter for letter in letters[:count]]
+
+
+def plan_volumes(count, volume_size, volume_type, volume_iops=None):
+    """
+        The EBS volumes to stripe the data directory over, volume_size GB in total. The IOPS are
+        the ones of each volume, the io1 volumes get 30 IOPS per GB unless they are given.
+
+    >>> [(v.device, v.volume_size, v.volume_iops) for v in plan_volumes(3, 100, 'io1')]
+    [('/dev/xvdk', 34, 1020), ('/dev/xvdl', 34, 1020), ('/dev/xvdm', 34, 1020)]
+    """
+    size = -(-int(volume_size) // count)
+    if volume_type == 'io1' and not volume_iops:
+        volume_iops = size * IO1_IOPS_PER_GB
+    return [BlockDevice(device, device, size, volume_iops, None) for device in get_device_names(count)]
+
+
+def plan_instance_store(instance_type):
+    """
+        The instance store devices of the instance type, empty if it has none. The NVMe devices are
+        named by the order they are attached in, whatever the name in the block device mapping.
+
+    >>> [(d.device, d.partition, d.virtual_name) for d in plan_instance_store('i3.4xlarge')]
+    [('/dev/xvdb', '/dev/nvme0n1', 'ephemeral0'), ('/dev/xvdc', '/dev/nvme1n1', 'ephemeral1')]
+    >>> plan_instance_store('m4.large')
+    []
+    """
+    store = INSTANCE_STORES.get(instance_type)
+    if store is None:
+        return []
+    devices = []
+    for number, device in enumerate(get_device_names(store.count, EPHEMERAL_DEVICE_LETTERS)):
+        partition = '/dev/nvme{0}n1'.format(number) if store.kind == 'nvme' else device
+        devices.append(BlockDevice(device, partition, store.size, None, 'ephemeral{0}'.format(number)))
+    return devices
+
+
+def get_volume_performance(volume_type, volume_size, volume_iops=None):
+    """
+        Baseline IOPS and throughput of an EBS volume
+
+    >>> get_volume_performance('gp2', 100), get_volume_performance('st1', 2000)
+    (Performance(iops=300, throughput=75.0), Performance(iops=500, throughput=80.0))
+    """
+    size = int(volume_size)
+    if volume_type == 'io1':
+        iops = int(volume_iops or size * IO1_IOPS_PER_GB)
+        return Performance(iops, min(320, iops / 4))  # up to 256 KiB per I/O
+    if volume_type == 'st1':
+        return Performance(500, min(500, size * 0.04))
+    if volume_type == 'sc1':
+        return Performance(250, min(250, size * 0.012))
+    if volume_type == 'standard':
+        return Performance(200, 90)
+    iops = min(max(100, size * 3), 10000)
+    return Performance(iops, min(iops / 4, 128 if size <= 170 else 160))
+
+
+def get_aggregate_performance(volumes, volume_type):
+    """ IOPS and throughput of the volumes, dicts of the fields of BlockDevice, striped together """
+    performances = [get_volume_performance(volume_type, v['volume_size'], v['volume_iops']) for v in volumes]
+    return Performance(sum(p.iops for p in performances), sum(p.throughput for p in performances))
+
+
+def get_ebs_limits(instance_type):
+    """
+        IOPS and throughput of the dedicated EBS bandwidth of the instance type, None if it has none
+        or it is not known
+
+    >>> get_ebs_limits('m4.large')
+    Performance(iops=3600, throughput=56.25)
+    """
+    limits = EBS_LIMITS.get(instance_type)
+    return Performance(limits[1], limits[0] / 8) if limits else None
+
+
+def get_stripe_options(fstype, stripe_size, count):
+    """
+        Mount options aligning the allocations of the filesystem with the stripes of a RAID0 array
+        of count devices with stripe_size KB chunks
+
+    >>> get_stripe_options('ext4', 512, 4), get_stripe_options('xfs', 512, 4), get_stripe_options('btrfs', 512, 4)
+    ('stripe=512', 'sunit=1024,swidth=4096', None)
+    """
+    if fstype.startswith('ext'):
+        return 'stripe={0}'.format(int(stripe_size) * count // 4)  # in 4 KB blocks
+    if fstype == 'xfs':
+        sunit = int(stripe_size) * 2  # in 512 byte sectors
+        return 'sunit={0},swidth={1}'.format(sunit, sunit * count)
+    return None
@@ -0,0 +1,219 @@
+'''
+Timing of the phases of the template, to find out which of the lookups makes senza init slow.
+
+With SPILO_TRACE=<file>, every phase is recorded as a span with its duration and counters: the
+AWS API calls, DNS queries and HTTP requests done in it, the bytes received and the cache hits.
+The spans are written when the process exits, in the Chrome trace event format if the file name
+ends with .json (to be opened in chrome://tracing or https://ui.perfetto.dev), as a plain text
+summary otherwise, or to the standard error with SPILO_TRACE=-.
+
+Without SPILO_TRACE, span() returns a shared no-op context and count() returns right away.
+'''
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+class Span:
+    """ Phase of the template, timed while the span is entered, and the counters of what was done in it """
+
+    __slots__ = ('tracer', 'name', 'args', 'started', 'finished', 'thread', 'counters')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.started = self.finished = None
+        self.thread = None
+        self.counters = Counter()
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        self.tracer.stack().append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finished = time.perf_counter()
+        self.tracer.stack().pop()
+        self.tracer.finish(self)
+        return False
+
+    @property
+    def duration(self):
+        return self.finished - self.started
+
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """ Finished spans of all threads of the process """
+
+    def __init__(self, path):
+        self.path = path
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def stack(self):
+        """ Spans entered in the current thread, the innermost last """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+    def finish(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, counter, n):
+        span = self.current()
+        if span is not None:
+            with self._lock:
+                span.counters[counter] += n
+
+    def chrome_trace(self):
+        """ The spans as complete events of the Chrome trace event format, times in microseconds """
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            args = dict(span.args)
+            args.update(span.counters)
+            events.append({'name': span.name, 'cat': 'spilo', 'ph': 'X', 'pid': pid, 'tid': span.thread,
+                           'ts': round((span.started - self._origin) * 1e6, 1),
+                           'dur': round(span.duration * 1e6, 1), 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        """ Plain text table with the number, total and maximum duration and the counters of the spans by name """
+        totals = OrderedDict()
+        for span in sorted(self.spans, key=lambda s: s.started):
+            total = totals.setdefault(span.name, {'count': 0, 'total': 0.0, 'max': 0.0, 'counters': Counter()})
+            total['count'] += 1
+            total['total'] += span.duration
+            total['max'] = max(total['max'], span.duration)
+            total['counters'].update(span.counters)
+        lines = ['{0:<40} {1:>6} {2:>11} {3:>11}  {4}'.format('span', 'count', 'total ms', 'max ms', 'counters')]
+        for name, total in sorted(totals.items(), key=lambda t: -t[1]['total']):
+            lines.append('{0:<40} {1:>6} {2:>11.1f} {3:>11.1f}  {4}'.format(
+                name, total['count'], total['total'] * 1000, total['max'] * 1000,
+                ' '.join('{0}={1}'.format(k, v) for k, v in sorted(total['counters'].items()))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        import multiprocessing
+
+        # the worker processes of generate_definitions must not overwrite the trace of the main process
+        if multiprocessing.current_process().name != 'MainProcess':
+            return
+        with self._lock:
+            if self.path == '-':
+                sys.stderr.write(self.summary())
+            elif self.path.endswith('.json'):
+                with open(self.path, 'w') as f:
+                    json.dump(self.chrome_trace(), f)
+            else:
+                with open(self.path, 'w') as f:
+                    f.write(self.summary())
+
+
+_tracer = None
+
+
+def enable(path):
+    """ Record the spans from now on, and write them to the path when the process exits """
+    global _tracer
+    _tracer = Tracer(path)
+    atexit.register(_tracer.write)
+    return _tracer
+
+
+def span(name, **args):
+    """
+        Context of a phase of the template, recorded as a span if tracing is enabled
+
+    >>> with span('lookup', region='eu-west-1'):
+    ...     count('api_calls')
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, args)
+
+
+def count(counter, n=1):
+    """ Add n to the counter of the innermost span of the current thread """
+    if _tracer is not None:
+        _tracer.count(counter, n)
+
+
+def bind(function):
+    """ The function, with the spans and the counters in other threads going to the current span """
+    if _tracer is None:
+        return function
+    tracer = _tracer
+    parent = tracer.current()
+
+    def bound(*args, **kwargs):
+        stack = tracer.stack()
+        stack.append(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.pop()
+    return bound if parent is not None else function
+
+
+def instrument_client(client):
+    """ Record every API call of the boto3 client as a span, counting the calls and the bytes received """
+    if _tracer is None:
+        return client
+    tracer = _tracer
+
+    def before_call(model, context, **kwargs):
+        tracer.count('api_calls', 1)
+        # not entered, a failed call would leave it on the stack of the thread
+        span = Span(tracer, '{0}.{1}'.format(client.meta.service_model.service_name, model.name), {})
+        span.thread = threading.get_ident()
+        span.started = time.perf_counter()
+        context['spilo_trace_span'] = span
+
+    def after_call(http_response, model, context, **kwargs):
+        span = context.pop('spilo_trace_span', None)
+        if span is None:
+            return
+        span.finished = time.perf_counter()
+        try:
+            received = int(http_response.headers.get('Content-Length') or 0)
+        except (AttributeError, ValueError):
+            received = 0
+        span.counters['bytes'] += received
+        tracer.count('bytes', received)
+        tracer.finish(span)
+
+    client.meta.events.register('before-call.*.*', before_call)
+    client.meta.events.register('after-call.*.*', after_call)
+    return client
+
+
+if os.environ.get('SPILO_TRACE'):
+    enable(os.environ['SPILO_TRACE'])
@@ -0,0 +1,184 @@
+'''
+PostgreSQL parameters derived from the resources of the instance type: its memory and number of
+vCPUs, and the kind of storage the data directory is on. Likewise the settings of the connection
+pooler in front of PostgreSQL.
+
+The memory settings follow the usual rules for mixed workloads: a quarter of the memory for
+shared_buffers, three quarters as the expected file system cache, and work_mem such that a few
+sorts in each connection fit in what is left. The parallel query settings are only set for the
+PostgreSQL versions that know them, since an unknown parameter keeps PostgreSQL from starting.
+'''
+
+import re
+from collections import OrderedDict, namedtuple
+
+InstanceType = namedtuple('InstanceType', 'vcpus memory')  # memory in GiB
+
+# per https://aws.amazon.com/ec2/instance-types/
+INSTANCE_TYPES = {
+    't2.nano': InstanceType(1, 0.5), 't2.micro': InstanceType(1, 1), 't2.small': InstanceType(1, 2),
+    't2.medium': InstanceType(2, 4), 't2.large': InstanceType(2, 8), 't2.xlarge': InstanceType(4, 16),
+    't2.2xlarge': InstanceType(8, 32),
+    'm3.medium': InstanceType(1, 3.75), 'm3.large': InstanceType(2, 7.5), 'm3.xlarge': InstanceType(4, 15),
+    'm3.2xlarge': InstanceType(8, 30),
+    'm4.large': InstanceType(2, 8), 'm4.xlarge': InstanceType(4, 16), 'm4.2xlarge': InstanceType(8, 32),
+    'm4.4xlarge': InstanceType(16, 64), 'm4.10xlarge': InstanceType(40, 160), 'm4.16xlarge': InstanceType(64, 256),
+    'c3.large': InstanceType(2, 3.75), 'c3.xlarge': InstanceType(4, 7.5), 'c3.2xlarge': InstanceType(8, 15),
+    'c3.4xlarge': InstanceType(16, 30), 'c3.8xlarge': InstanceType(32, 60),
+    'c4.large': InstanceType(2, 3.75), 'c4.xlarge': InstanceType(4, 7.5), 'c4.2xlarge': InstanceType(8, 15),
+    'c4.4xlarge': InstanceType(16, 30), 'c4.8xlarge': InstanceType(36, 60),
+    'r3.large': InstanceType(2, 15.25), 'r3.xlarge': InstanceType(4, 30.5), 'r3.2xlarge': InstanceType(8, 61),
+    'r3.4xlarge': InstanceType(16, 122), 'r3.8xlarge': InstanceType(32, 244),
+    'r4.large': InstanceType(2, 15.25), 'r4.xlarge': InstanceType(4, 30.5), 'r4.2xlarge': InstanceType(8, 61),
+    'r4.4xlarge': InstanceType(16, 122), 'r4.8xlarge': InstanceType(32, 244), 'r4.16xlarge': InstanceType(64, 488),
+    'i2.xlarge': InstanceType(4, 30.5), 'i2.2xlarge': InstanceType(8, 61), 'i2.4xlarge': InstanceType(16, 122),
+    'i2.8xlarge': InstanceType(32, 244),
+    'i3.large': InstanceType(2, 15.25), 'i3.xlarge': InstanceType(4, 30.5), 'i3.2xlarge': InstanceType(8, 61),
+    'i3.4xlarge': InstanceType(16, 122), 'i3.8xlarge': InstanceType(32, 244), 'i3.16xlarge': InstanceType(64, 488),
+    'd2.xlarge': InstanceType(4, 30.5), 'd2.2xlarge': InstanceType(8, 61), 'd2.4xlarge': InstanceType(16, 122),
+    'd2.8xlarge': InstanceType(36, 244),
+    'x1.16xlarge': InstanceType(64, 976), 'x1.32xlarge': InstanceType(128, 1952),
+}
+HDD_VOLUME_TYPES = ('st1', 'sc1', 'standard')
+DEFAULT_MAX_CONNECTIONS = 100
+MAX_MAINTENANCE_WORK_MEM = 2 * 1024 * 1024  # kB
+MIN_WORK_MEM = 64  # kB
+MAX_WAL_SIZE = 4 * 1024 * 1024  # kB
+MIN_WAL_SIZE = 1024 * 1024  # kB, the default of PostgreSQL
+MAX_PARALLEL_WORKERS_PER_GATHER = 4
+MIN_WORKER_PROCESSES = 8  # the default of PostgreSQL, also used by the extensions
+POOL_MODES = ('session', 'transaction', 'statement')
+POOL_SIZE_PER_VCPU = 4  # active backends a vCPU keeps busy without them waiting for each other
+MIN_POOL_SIZE = 8
+# connections not given to the pooler: superuser_reserved_connections, replication, Patroni and monitoring
+POOLER_RESERVED_CONNECTIONS = 10
+CLIENT_CONNECTIONS_PER_GB = 500
+MIN_CLIENT_CONNECTIONS = 1000
+MAX_CLIENT_CONNECTIONS = 10000
+UNKNOWN_INSTANCE_TYPE = InstanceType(2, 4)
+
+_spilo_version = re.compile(r'spilo-(\d+(?:\.\d+)?)')
+
+
+def format_memory(kb):
+    """
+        The amount of memory in kB in the largest unit of PostgreSQL it can be written in without a fraction
+
+    >>> [format_memory(kb) for kb in (64, 1536, 2048, 4 * 1024 * 1024, 5000)]
+    ['64kB', '1536kB', '2MB', '4GB', '5000kB']
+    """
+    kb = int(kb)
+    for unit, size in (('GB', 1024 * 1024), ('MB', 1024)):
+        if kb >= size and kb % size == 0:
+            return '{0}{1}'.format(kb // size, unit)
+    return '{0}kB'.format(kb)
+
+
+def round_memory(kb):
+    """ The amount of memory rounded down to whole MB, or kB if less than a MB """
+    return kb - kb % 1024 if kb >= 1024 else kb
+
+
+def get_postgresql_version(docker_image):
+    """
+        The major version of PostgreSQL of the Spilo image, None if it is not known
+
+    >>> get_postgresql_version('registry.opensource.zalan.do/acid/spilo-9.6:1.1-p5')
+    (9, 6)
+    >>> get_postgresql_version('registry.opensource.zalan.do/acid/spilo-10:1.3-p1')
+    (10,)
+    """
+    match = _spilo_version.search(docker_image or '')
+    return tuple(int(n) for n in match.group(1).split('.')) if match else None
+
+
+def get_storage_kind(volume_type):
+    return 'hdd' if volume_type in HDD_VOLUME_TYPES else 'ssd'
+
+
+def tune_postgresql(instance_type, storage='ssd', volume_size=None, version=(9, 5), max_connections=None):
+    """
+        PostgreSQL parameters for the instance type, empty if its resources are not known. The volume
+        size in GB limits the WAL, max_connections is needed to divide the memory between the sorts.
+
+    >>> for name, value in tune_postgresql('m4.large', 'ssd', 50, (9, 6)).items():
+    ...     print(name, value)
+    shared_buffers 2GB
+    effective_cache_size 6GB
+    work_mem 20MB
+    maintenance_work_mem 512MB
+    max_wal_size 4GB
+    checkpoint_completion_target 0.9
+    random_page_cost 1.1
+    effective_io_concurrency 200
+    max_worker_processes 8
+    max_parallel_workers_per_gather 1
+    >>> tune_postgresql('x0.large')
+    OrderedDict()
+    """
+    resources = INSTANCE_TYPES.get(instance_type)
+    if resources is None:
+        return OrderedDict()
+    memory = int(resources.memory * 1024 * 1024)
+    shared_buffers = round_memory(memory // 4)
+    workers_per_gather = min(MAX_PARALLEL_WORKERS_PER_GATHER, resources.vcpus // 2)
+    connections = int(max_connections or DEFAULT_MAX_CONNECTIONS)
+    # a few sorts or hashes per query, each of the parallel workers of the query having its own
+    work_mem = (memory - shared_buffers) // (connections * 3) // max(1, workers_per_gather)
+    max_wal_size = MAX_WAL_SIZE
+    if volume_size:
+        # at most a tenth of the volume, the WAL may grow to a multiple of max_wal_size at times
+        max_wal_size = max(MIN_WAL_SIZE, min(max_wal_size, int(volume_size) * 1024 * 1024 // 10))
+
+    parameters = OrderedDict([
+        ('shared_buffers', format_memory(shared_buffers)),
+        ('effective_cache_size', format_memory(round_memory(memory * 3 // 4))),
+        ('work_mem', format_memory(round_memory(max(MIN_WORK_MEM, work_mem)))),
+        ('maintenance_work_mem', format_memory(round_memory(min(MAX_MAINTENANCE_WORK_MEM, memory // 16)))),
+        ('max_wal_size', format_memory(round_memory(max_wal_size))),
+        ('checkpoint_completion_target', '0.9'),
+        ('random_page_cost', '4' if storage == 'hdd' else '1.1'),
+        ('effective_io_concurrency', '2' if storage == 'hdd' else '200'),
+        ('max_worker_processes', str(max(MIN_WORKER_PROCESSES, resources.vcpus))),
+    ])
+    version = version or (9, 5)
+    if version >= (9, 6):
+        parameters['max_parallel_workers_per_gather'] = str(workers_per_gather)
+    if version >= (10,):
+        parameters['max_parallel_workers'] = str(resources.vcpus)
+    if version >= (11,):
+        parameters['max_parallel_maintenance_workers'] = str(workers_per_gather)
+    return parameters
+
+
+def tune_pooler(instance_type, max_connections=None, pool_mode=None, pool_size=None):
+    """
+        PgBouncer settings for the instance type. The pool has a few connections per vCPU, at most
+        max_connections less the ones reserved for everything else. Where the vCPUs can keep all of
+        those busy anyway, the pool is in session mode and only takes the cost of the connection churn
+        off PostgreSQL, otherwise it is in transaction mode and shares the backends between the clients.
+
+    >>> for name, value in tune_pooler('m4.large').items():
+    ...     print(name, value)
+    pool_mode transaction
+    default_pool_size 8
+    reserve_pool_size 2
+    max_db_connections 90
+    max_client_conn 4000
+    >>> tune_pooler('r4.16xlarge')['pool_mode']
+    'session'
+    """
+    resources = INSTANCE_TYPES.get(instance_type, UNKNOWN_INSTANCE_TYPE)
+    max_db_connections = max(1, int(max_connections or DEFAULT_MAX_CONNECTIONS) - POOLER_RESERVED_CONNECTIONS)
+    if pool_size:
+        pool_size = int(pool_size)
+    else:
+        pool_size = min(max_db_connections, max(MIN_POOL_SIZE, resources.vcpus * POOL_SIZE_PER_VCPU))
+    client_connections = int(resources.memory * CLIENT_CONNECTIONS_PER_GB)
+    return OrderedDict([
+        ('pool_mode', pool_mode or ('session' if pool_size >= max_db_connections else 'transaction')),
+        ('default_pool_size', pool_size),
+        ('reserve_pool_size', max(1, pool_size // 4)),
+        ('max_db_connections', max_db_connections),
+        ('max_client_conn', min(MAX_CLIENT_CONNECTIONS, max(MIN_CLIENT_CONNECTIONS, client_connections))),
+    ])
@@ -2,27 +2,81 @@
 The template for the PostgreSQL-based Database as a Service.
 '''
 
-import random
+import datetime
+import json
+import os
 import string
 import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from urllib.parse import urlparse
 
-import boto3
-import requests
-from requests.exceptions import RequestException
-import dns.resolver
-from clickclick import Action, fatal_error
-from senza.aws import encrypt, list_kms_keys
-from senza.utils import pystache_render
-
-from senza.templates._helper import check_s3_bucket, get_account_alias
+from acid.senza.templates import _http as http
+from acid.senza.templates import _trace as trace
+from acid.senza.templates._availability import AVAILABILITY_PROFILES, DEFAULT_AVAILABILITY_PROFILE, \
+    get_availability
+from acid.senza.templates._aws import (check_s3_bucket, encrypt, get_account_alias, get_account_id, get_client,
+                                       get_session, list_kms_keys)
+from acid.senza.templates._cache import DiscoveryCache
+from acid.senza.templates._dns import DNSTimeout, get_resolver
+from acid.senza.templates._pricing import find_on_demand_offer, load_price_index
+from acid.senza.templates._replay import get_snapshot
+from acid.senza.templates._spot import SECONDS_PER_DAY, SpotAnalysis, analyze_spot_prices, load_spot_price_history
+from acid.senza.templates._storage import (INSTANCE_STORES, MAX_VOLUMES, RAID_DEVICE, get_aggregate_performance,
+                                           get_ebs_limits, get_stripe_options, plan_instance_store, plan_volumes)
+from acid.senza.templates._tuning import POOL_MODES, get_postgresql_version, get_storage_kind, tune_pooler, \
+    tune_postgresql
 
 POSTGRES_PORT = 5432
 HEALTHCHECK_PORT = 8008
+POOLER_PORT = 6432
 SPILO_IMAGE_ADDRESS = "registry.opensource.zalan.do/acid/spilo-9.5"
 ODD_SG_GROUP_NAME_REGEX = 'Odd.*'
 ZMON_SG_GROUP_NAME_REGEX = 'app-zmon-db'
 PRICE_URL = "https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/index.json"
+REGISTRY_TAGS_URL = "https://{registry}/teams/{team}/artifacts/{artifact}/tags"
+PRICE_CHUNK_SIZE = 1024 * 1024
+PRICE_INDEX_FILE = 'ec2-on-demand-prices.tsv'
+PRICE_INDEX_TTL = 24 * 3600
+DISCOVERY_WORKERS = 16
+INSTANCE_STORE_MIN_INSTANCES = 3
+VOLUME_STRIPE_SIZE = 512  # KB, the default chunk size of mdadm, which Taupage assembles the RAID0 array with
+SPOT_PRICE_PERCENTILE = 90
+SPOT_PRICE_HISTORY_DAYS = 30
+SPOT_PRICE_HISTORY_RETENTION_DAYS = 90  # how far back describe_spot_price_history goes
+SECURITY_GROUP_RULES_LIMIT = 60  # default limit of the inbound rules of a VPC security group
+LOAD_BALANCER_SECURITY_GROUPS_LIMIT = 5
+PASSWORD_ALPHABET = string.ascii_uppercase + string.digits
+TEAM_REGIONS = ('eu-west-1', 'eu-central-1')
+ACCOUNT_ID_TTL = 12 * 3600  # temporary credentials last at most this long, their access keys are not used again
+DISCOVERY_CACHE_TTLS = {
+    'wal_s3_bucket': 24 * 3600,
+    'discovery_domain': 3600,
+    'nat_gateway_addresses': 900,
+    'odd_instance_addresses': 900,
+    'security_groups': 900,
+    'kms_key': 3600,
+}
+TEAM_AVAILABILITY_ZONES = ('a', 'b', 'c')
+EC2_PRICING_LOCATIONS = {
+    'eu-central-1': 'EU (Frankfurt)',
+    'eu-west-1': 'EU (Ireland)',
+}
+
+_price_index = None
+_password_table = bytes(ord(PASSWORD_ALPHABET[b % len(PASSWORD_ALPHABET)]) for b in range(256))
+_password_rejected_bytes = bytes(range(256 - 256 % len(PASSWORD_ALPHABET), 256))
+_price_index_lock = threading.Lock()
+_discovery_caches = {}
+_discovery_caches_lock = threading.Lock()
+_parsed_template = None
+_hosted_zone_ids = {}
+# name: value of a PostgreSQL parameter, the value either quoted or up to the next comma
+_postgresql_parameter = re.compile(r'''
+    \s*(?P<name>[^\s:,]+)\s*:\s*
+    (?:"(?P<double>(?:[^"\\]|\\.)*)"|'(?P<single>(?:[^']|'')*)'|(?P<plain>[^,]*?))
+    \s*(?:,|$)''', re.VERBOSE)
 
 # This template goes through 2 formatting phases. Once during the init phase and once during
 # the create phase of senza. Some placeholders should be evaluated during create.
@@ -35,6 +89,8 @@ SenzaInfo:
   StackName: spilo
   Tags:
     - SpiloCluster: "{{version}}"
+    - SpiloAvailabilityProfile: "{{availability_profile}}"
+    - SpiloFailoverSeconds: "{{availability.failover_time}}"
 
 # a list of senza components to apply to the definition
 SenzaComponents:
@@ -58,7 +114,8 @@ SenzaComponents:
       EbsOptimized: True
       {{/ebs_optimized}}
       BlockDeviceMappings:
-        - DeviceName: /dev/xvdk
+        {{#block_devices}}
+        - DeviceName: {{device}}
           {{#use_ebs}}
           Ebs:
             VolumeSize: {{volume_size}}
@@ -70,6 +127,10 @@ SenzaComponents:
             Iops: {{volume_iops}}
             {{/volume_iops}}
           {{/use_ebs}}
+          {{^use_ebs}}
+          VirtualName: {{virtual_name}}
+          {{/use_ebs}}
+        {{/block_devices}}
       ElasticLoadBalancer:
         - PostgresLoadBalancer
         {{#add_replica_loadbalancer}}
@@ -89,6 +150,9 @@ SenzaComponents:
         ports:
           {{postgres_port}}: {{postgres_port}}
           {{healthcheck_port}}: {{healthcheck_port}}
+          {{#use_pooler}}
+          {{pooler_port}}: {{pooler_port}}
+          {{/use_pooler}}
         etcd_discovery_domain: "{{discovery_domain}}"
         environment:
           SCOPE: "{{version}}"
@@ -101,9 +165,15 @@ SenzaComponents:
           {{#ldap_url}}
           LDAP_URL: {{ldap_url}}
           {{/ldap_url}}
+          {{#pooler_settings}}
+          {{name}}: "{{value}}"
+          {{/pooler_settings}}
           PATRONI_CONFIGURATION: | ## https://github.com/zalando/patroni#yaml-configuration
             bootstrap:
               dcs:
+                ttl: {{availability.ttl}}
+                loop_wait: {{availability.loop_wait}}
+                retry_timeout: {{availability.retry_timeout}}
                 postgresql:
                   parameters:
                     logging_collector: on
@@ -116,7 +186,7 @@ SenzaComponents:
                     shared_preload_libraries: pg_stat_statements
                     track_functions: all
                 {{#postgresqlconf}}
-                    {{postgresqlconf}}
+                    {{{postgresqlconf}}}
                 {{/postgresqlconf}}
               initdb:
                 - auth-host: md5
@@ -127,6 +197,19 @@ SenzaComponents:
                 - hostssl   all +zalandos all ldap ldapserver="localhost" ldapprefix="uid=" ldapsuffix=",{{ldap_suffix}}"
                 {{/ldap_suffix}}
                 - hostssl   all all all md5
+            {{^use_ebs}}
+            postgresql:
+              create_replica_method:
+                - wal_e
+                - basebackup
+              wal_e:
+                command: patroni_wale_restore
+                envdir: /home/postgres/etc/wal-e.d/env
+                threshold_megabytes: 10240
+                threshold_backup_size_percentage: 30
+                retries: 2
+                no_master: 1
+            {{/use_ebs}}
         root: True
         sysctl:
           vm.overcommit_memory: 2
@@ -135,9 +218,19 @@ SenzaComponents:
           vm.dirty_background_ratio: 1
           vm.swappiness: 1
         appdynamics_application: 'spilo-{{version}}'
+        {{#raid_device}}
+        volumes:
+          raid:
+            {{raid_device}}:
+              level: 0
+              devices:
+                {{#block_devices}}
+                - {{partition}}
+                {{/block_devices}}
+        {{/raid_device}}
         mounts:
           /home/postgres/pgdata:
-            partition: /dev/xvdk
+            partition: {{data_partition}}
             filesystem: {{fstype}}
             {{#snapshot_id}}
             erase_on_boot: false
@@ -152,7 +245,7 @@ Resources:
     Type: AWS::Route53::RecordSet
     Properties:
       Type: CNAME
-      TTL: 20
+      TTL: {{availability.dns_ttl}}
       HostedZoneName: {{hosted_zone}}
       {{#replica_dns_name}}
       Name: {{replica_dns_name}}
@@ -169,22 +262,24 @@ Resources:
     Properties:
       CrossZone: true
       HealthCheck:
-        HealthyThreshold: 2
-        Interval: 5
+        HealthyThreshold: {{availability.healthy_threshold}}
+        Interval: {{availability.health_check_interval}}
         Target: HTTP:{{healthcheck_port}}/replica
-        Timeout: 3
-        UnhealthyThreshold: 2
+        Timeout: {{availability.health_check_timeout}}
+        UnhealthyThreshold: {{availability.unhealthy_threshold}}
       Listeners:
-        - InstancePort: {{postgres_port}}
+        - InstancePort: {{instance_port}}
           LoadBalancerPort: {{postgres_port}}
           Protocol: TCP
       LoadBalancerName: "spilo-{{version}}-repl"
       ConnectionSettings:
-        IdleTimeout: 3600
+        IdleTimeout: {{availability.idle_timeout}}
       SecurityGroups:
+        {{#spilo_replica_security_groups}}
         - Fn::GetAtt:
-          - SpiloReplicaSG
+          - {{name}}
           - GroupId
+        {{/spilo_replica_security_groups}}
       Scheme: internet-facing
       Subnets:
         Fn::FindInMap:
@@ -196,7 +291,7 @@ Resources:
     Type: AWS::Route53::RecordSet
     Properties:
       Type: CNAME
-      TTL: 20
+      TTL: {{availability.dns_ttl}}
       HostedZoneName: {{hosted_zone}}
       {{#master_dns_name}}
       Name: {{master_dns_name}}
@@ -213,22 +308,24 @@ Resources:
     Properties:
       CrossZone: true
       HealthCheck:
-        HealthyThreshold: 2
-        Interval: 5
+        HealthyThreshold: {{availability.healthy_threshold}}
+        Interval: {{availability.health_check_interval}}
         Target: HTTP:{{healthcheck_port}}/master
-        Timeout: 3
-        UnhealthyThreshold: 2
+        Timeout: {{availability.health_check_timeout}}
+        UnhealthyThreshold: {{availability.unhealthy_threshold}}
       Listeners:
-        - InstancePort: {{postgres_port}}
+        - InstancePort: {{instance_port}}
           LoadBalancerPort: {{postgres_port}}
           Protocol: TCP
       LoadBalancerName: "spilo-{{version}}"
       ConnectionSettings:
-        IdleTimeout: 3600
+        IdleTimeout: {{availability.idle_timeout}}
       SecurityGroups:
+        {{#spilo_master_security_groups}}
         - Fn::GetAtt:
-          - SpiloMasterSG
+          - {{name}}
           - GroupId
+        {{/spilo_master_security_groups}}
       Scheme: internet-facing
       Subnets:
         Fn::FindInMap:
@@ -276,19 +373,33 @@ Resources:
             Resource:
               - {{kms_arn}}
           {{/kms_arn}}
-  SpiloMasterSG:
+  {{#spilo_master_security_groups}}
+  {{name}}:
     Type: "AWS::EC2::SecurityGroup"
     Properties:
-      GroupDescription: "Security Group for the master ELB of Spilo: {{version}}"
+      GroupDescription: "Security Group for the master ELB of Spilo: {{version}}{{description_suffix}}"
       SecurityGroupIngress:
-        {{spilo_security_group_ingress_rules_block}}
+        {{#rules}}
+        - IpProtocol: {{IpProtocol}}
+          FromPort: {{FromPort}}
+          ToPort: {{ToPort}}
+          CidrIp: {{CidrIp}}
+        {{/rules}}
+  {{/spilo_master_security_groups}}
   {{#add_replica_loadbalancer}}
-  SpiloReplicaSG:
+  {{#spilo_replica_security_groups}}
+  {{name}}:
     Type: "AWS::EC2::SecurityGroup"
     Properties:
-      GroupDescription: "Security Group for the replica ELB of Spilo: {{version}}"
+      GroupDescription: "Security Group for the replica ELB of Spilo: {{version}}{{description_suffix}}"
       SecurityGroupIngress:
-        {{spilo_security_group_ingress_rules_block}}
+        {{#rules}}
+        - IpProtocol: {{IpProtocol}}
+          FromPort: {{FromPort}}
+          ToPort: {{ToPort}}
+          CidrIp: {{CidrIp}}
+        {{/rules}}
+  {{/spilo_replica_security_groups}}
   {{/add_replica_loadbalancer}}
   SpiloMemberSG:
     Type: "AWS::EC2::SecurityGroup"
@@ -296,8 +407,8 @@ Resources:
       GroupDescription: "Security Group for members of Spilo: {{version}}"
       SecurityGroupIngress:
         - IpProtocol: tcp
-          FromPort: {{postgres_port}}
-          ToPort: {{postgres_port}}
+          FromPort: {{instance_port}}
+          ToPort: {{instance_port}}
           SourceSecurityGroupId:
             Fn::GetAtt:
               - SpiloMasterSG
@@ -311,8 +422,8 @@ Resources:
               - GroupId
         {{#add_replica_loadbalancer}}
         - IpProtocol: tcp
-          FromPort: {{postgres_port}}
-          ToPort: {{postgres_port}}
+          FromPort: {{instance_port}}
+          ToPort: {{instance_port}}
           SourceSecurityGroupId:
             Fn::GetAtt:
               - SpiloReplicaSG
@@ -386,9 +497,11 @@ def set_default_variables(variables):
     variables.setdefault('team_gateway_zone', None)
     # End of required variables #
     variables.setdefault('add_replica_loadbalancer', False)
+    variables.setdefault('availability_profile', DEFAULT_AVAILABILITY_PROFILE)
+    variables.setdefault('availability', LazyDefault(get_availability, 'availability_profile'))
     variables.setdefault('discovery_domain', None)
     variables.setdefault('master_dns_name', None)
-    variables.setdefault('docker_image', get_latest_image())
+    variables.setdefault('docker_image', LazyDefault(get_latest_image))
     variables.setdefault('ebs_optimized', None)
     variables.setdefault('fsoptions', 'noatime,nodiratime,nobarrier')
     variables.setdefault('fstype', 'ext4')
@@ -400,11 +513,22 @@ def set_default_variables(variables):
     variables.setdefault('ldap_suffix', None)
     variables.setdefault('kms_arn', None)
     variables.setdefault('odd_sg_id', None)
-    variables.setdefault('pgpassword_admin', generate_random_password())
-    variables.setdefault('pgpassword_standby', generate_random_password())
-    variables.setdefault('pgpassword_superuser', generate_random_password())
+    variables.setdefault('pgpassword_admin', LazyDefault(generate_random_password))
+    variables.setdefault('pgpassword_standby', LazyDefault(generate_random_password))
+    variables.setdefault('pgpassword_superuser', LazyDefault(generate_random_password))
     variables.setdefault('postgresqlconf', None)
+    variables.setdefault('postgresql_parameters', None)
+    variables.setdefault('postgresql_tuning', True)
     variables.setdefault('postgres_port', POSTGRES_PORT)
+    variables.setdefault('use_pooler', False)
+    variables.setdefault('pooler_port', POOLER_PORT)
+    variables.setdefault('pooler_mode', None)
+    variables.setdefault('pooler_pool_size', None)
+    variables.setdefault('pooler_images', None)
+    variables.setdefault('instance_port', LazyDefault(get_instance_port, 'use_pooler', 'postgres_port', 'pooler_port'))
+    variables.setdefault('pooler_settings', LazyDefault(get_pooler_settings, 'use_pooler', 'pooler_port',
+                                                        'instance_type', 'postgresql_parameters', 'pooler_mode',
+                                                        'pooler_pool_size'))
     variables.setdefault('promotheus_port', '9100')
     variables.setdefault('replica_dns_name', None)
     variables.setdefault('snapshot_id', None)
@@ -412,15 +536,79 @@ def set_default_variables(variables):
     variables.setdefault('volume_iops', None)
     variables.setdefault('volume_size', 50)
     variables.setdefault('volume_type', 'gp2')
+    variables.setdefault('volume_count', 1)
+    variables.setdefault('block_devices', LazyDefault(get_block_devices, 'use_ebs', 'instance_type', 'volume_count',
+                                                      'volume_size', 'volume_type', 'volume_iops'))
+    variables.setdefault('raid_device', LazyDefault(get_raid_device, 'block_devices'))
+    variables.setdefault('data_partition', LazyDefault(get_data_partition, 'block_devices', 'raid_device'))
     variables.setdefault('wal_s3_bucket', None)
     variables.setdefault('zmon_sg_id', None)
+    variables.setdefault('team_regions', ','.join(TEAM_REGIONS))
+    variables.setdefault('team_availability_zones', ','.join(TEAM_AVAILABILITY_ZONES))
     variables.setdefault('use_spot_instances', False)
     variables.setdefault('spot_price', 0)
+    variables.setdefault('spot_price_percentile', SPOT_PRICE_PERCENTILE)
+    variables.setdefault('spot_price_history_days', SPOT_PRICE_HISTORY_DAYS)
+    variables.setdefault('refresh_cache', False)
+    variables.setdefault('invalidate_cache', None)
+    variables.setdefault('security_group_rules_limit', SECURITY_GROUP_RULES_LIMIT)
+
+    return variables
+
+
+class LazyDefault:
+    """
+        Default value of a variable that is only computed when the variable is needed, from the values
+        of the variables listed in requires. The computed value replaces the LazyDefault in the variables,
+        thus, it is computed at most once.
+    """
+
+    def __init__(self, function, *requires):
+        self.function = function
+        self.requires = requires
+
 
+def resolve_variable(variables, name):
+    """
+        Value of the variable, computing it and the variables it depends on if they are LazyDefaults
+
+    >>> variables = {'a': LazyDefault(lambda: 2), 'b': LazyDefault(lambda a: a * 10, 'a')}
+    >>> resolve_variable(variables, 'b'), variables
+    (20, {'a': 2, 'b': 20})
+    """
+    value = variables.get(name)
+    if isinstance(value, LazyDefault):
+        value = value.function(*[resolve_variable(variables, r) for r in value.requires])
+        variables[name] = value
+    return value
+
+
+def resolve_variables(variables):
+    for name in list(variables):
+        resolve_variable(variables, name)
     return variables
 
 
 def gather_user_variables(variables, account_info, region):
+    with trace.span('gather_user_variables'):
+        with trace.span('prepare_variables'):
+            prepare_variables(variables, region.Region)
+
+        # all lookups in AWS and DNS are independent of each other, except for the encryption of
+        # passwords that needs the KMS key, and run concurrently.
+        tasks = get_environment_tasks(variables, region.Region) + get_cluster_tasks(variables, region.Region) + \
+            get_spot_price_tasks([variables], region.Region)
+        try:
+            results = run_discovery(tasks)
+        except DiscoveryError as e:
+            fatal_error(str(e))
+
+        with trace.span('apply_discovery_results'):
+            return apply_discovery_results(variables, results)
+
+
+def prepare_variables(variables, region):
+    """ Set the defaults, validate and derive the variables that do not need any lookups """
 
     set_default_variables(variables)
 
@@ -432,17 +620,19 @@ def gather_user_variables(variables, account_info, region):
         fatal_error("Missing values for the following variables: {0}".format(', '.join(missing)))
 
     # redefine the region per the user input
-    if variables['team_region'] != region.Region:
+    if variables['team_region'] != region:
         fatal_error("Current region {0} do not match the requested region {1}\n"
                     "Change the currect region with --region option or set AWS_DEFAULT_REGION variable.".
-                    format(region.Region, variables['team_region']))
-
-    variables['wal_s3_bucket'] = '{}-{}-spilo-dbaas'.format(get_account_alias(), region.Region)
+                    format(region, variables['team_region']))
 
     for name in ('team_gateway_zone', 'hosted_zone'):
         if variables[name][-1] != '.':
             variables[name] += '.'
 
+    # senza init -v passes the flags as strings, which the template sections would take as true
+    for name in ('use_ebs', 'use_pooler'):
+        variables[name] = is_true(variables[name])
+
     # split the ldap url into the URL and suffix (path component)
     if variables['ldap_url']:
         url = urlparse(variables['ldap_url'])
@@ -461,61 +651,382 @@ def gather_user_variables(variables, account_info, region):
             fatal_error("{0} should end with {1}".
                         format(v.replace('_', ' '), variables['hosted_zone'][:-1]))
 
+    if variables['availability_profile'] not in AVAILABILITY_PROFILES:
+        fatal_error("availability_profile should be one of {0}".format(', '.join(sorted(AVAILABILITY_PROFILES))))
+    resolve_variable(variables, 'availability')
+
     if variables['ldap_url'] and not variables['ldap_suffix']:
         fatal_error("LDAP URL is missing the suffix: shoud be in a format: "
                     "ldap[s]://example.com[:port]/ou=people,dc=example,dc=com")
 
-    # pick up the proper etcd address depending on the region
-    variables['discovery_domain'] = detect_etcd_discovery_domain_for_region(variables['hosted_zone'],
-                                                                            region.Region)
+    # the parameters derived from the instance type, the ones from postgresqlconf take precedence
+    configured = parse_postgresql_configuration(variables['postgresqlconf']) if variables['postgresqlconf'] else {}
+    parameters = OrderedDict()
+    if is_true(variables['postgresql_tuning']):
+        parameters = get_tuned_parameters(variables, configured.get('max_connections'))
+    parameters.update(configured)
+    if parameters:
+        variables['postgresql_parameters'] = parameters
+        variables['postgresqlconf'] = format_postgresql_parameters(parameters)
+
+    if not 0 < float(variables['spot_price_percentile']) <= 100:
+        fatal_error("spot_price_percentile should be above 0 and at most 100")
+    if not 0 < int(variables['spot_price_history_days']) <= SPOT_PRICE_HISTORY_RETENTION_DAYS:
+        fatal_error("spot_price_history_days should be between 1 and {0}".format(SPOT_PRICE_HISTORY_RETENTION_DAYS))
+    if int(variables['security_group_rules_limit']) <= 0:
+        fatal_error("security_group_rules_limit should be above 0")
+
+    if variables['invalidate_cache'] and variables['invalidate_cache'] not in ('all',) + tuple(DISCOVERY_CACHE_TTLS):
+        fatal_error("invalidate_cache should be all or one of {0}".format(', '.join(sorted(DISCOVERY_CACHE_TTLS))))
+
+    if variables['use_pooler']:
+        prepare_pooler(variables)
+    prepare_storage(variables)
+    variables['ebs_optimized'] = ebs_optimized_supported(variables['instance_type'])
 
-    # get the IP addresses of the NAT gateways to acess a given ELB.
-    variables['nat_gateway_addresses'] = detect_eu_team_nat_gateways(variables['team_gateway_zone'])
-    variables['odd_instance_addresses'] = detect_eu_team_odd_instances(variables['team_gateway_zone'])
-    variables['spilo_security_group_ingress_rules_block'] = \
-        generate_spilo_master_security_group_ingress(variables['nat_gateway_addresses'] +
-                                                     variables['odd_instance_addresses'])
+    return variables
 
-    if variables['postgresqlconf']:
-        variables['postgresqlconf'] = generate_postgresql_configuration(variables['postgresqlconf'])
 
-    variables['odd_sg_id'] = detect_security_group(region.Region, ODD_SG_GROUP_NAME_REGEX)
-    variables['zmon_sg_id'] = detect_security_group(region.Region, ZMON_SG_GROUP_NAME_REGEX)
+def prepare_storage(variables):
+    """
+        The block devices of the data directory, striped with RAID0 when there are several volumes,
+        and a warning if the volumes can do more than the EBS bandwidth of the instance type. Without
+        use_ebs, the data directory is on the instance store, which is empty whenever an instance starts.
+
+    >>> variables = prepare_storage(set_default_variables({'volume_count': 2, 'volume_size': 100,
+    ...                                                    'instance_type': 'r4.2xlarge'}))
+    >>> [d['device'] for d in variables['block_devices']], variables['data_partition'], variables['fsoptions']
+    (['/dev/xvdk', '/dev/xvdl'], '/dev/md/pgdata', 'noatime,nodiratime,nobarrier,stripe=256')
+    >>> variables = prepare_storage(set_default_variables({'use_ebs': False, 'instance_type': 'i3.8xlarge'}))
+    >>> [d['partition'] for d in variables['block_devices']], variables['fsoptions']
+    (['/dev/nvme0n1', '/dev/nvme1n1', '/dev/nvme2n1', '/dev/nvme3n1'], 'noatime,nodiratime,nobarrier,stripe=512')
+    """
+    count = int(variables['volume_count'])
+    if not 0 < count <= MAX_VOLUMES:
+        fatal_error("volume_count should be between 1 and {0}".format(MAX_VOLUMES))
+    if not variables['use_ebs']:
+        if not plan_instance_store(variables['instance_type']):
+            fatal_error("{0} has no instance store, the data directory needs use_ebs".format(
+                variables['instance_type']))
+        if count > 1:
+            fatal_error("volume_count only applies to EBS volumes, all devices of the instance store are used")
+        if variables['snapshot_id']:
+            fatal_error("A snapshot can only be restored to an EBS volume, it needs use_ebs")
+        # a member that lost its data restores it from the backup while the others keep serving
+        if int(variables['number_of_instances']) < INSTANCE_STORE_MIN_INSTANCES:
+            fatal_error("The data on the instance store is lost with the instance, number_of_instances should be "
+                        "at least {0} to keep a replica while a member restores from the backup".format(
+                            INSTANCE_STORE_MIN_INSTANCES))
+    elif count > 1 and variables['snapshot_id']:
+        fatal_error("A snapshot can only be restored to a single volume, set volume_count to 1")
+
+    volumes = resolve_variable(variables, 'block_devices')
+    variables['volume_iops'] = volumes[0]['volume_iops']
+    if resolve_variable(variables, 'raid_device'):
+        options = get_stripe_options(variables['fstype'], VOLUME_STRIPE_SIZE, len(volumes))
+        names = [option.split('=')[0] for option in variables['fsoptions'].split(',')]
+        if options and not any(name in ('stripe', 'sunit', 'swidth') for name in names):
+            variables['fsoptions'] += ',' + options
+    resolve_variable(variables, 'data_partition')
+
+    limits = get_ebs_limits(variables['instance_type'])
+    if variables['use_ebs'] and limits:
+        performance = get_aggregate_performance(volumes, variables['volume_type'])
+        if performance.iops > limits.iops or performance.throughput > limits.throughput:
+            warning("The volumes can do {0} IOPS and {1:.0f} MB/s, {2} is limited to {3} IOPS and {4:.0f} MB/s of EBS "
+                    "traffic".format(performance.iops, performance.throughput, variables['instance_type'],
+                                     limits.iops, limits.throughput))
+    return variables
 
-    if variables['volume_type'] == 'io1' and not variables['volume_iops']:
-        pio_max = variables['volume_size'] * 30
-        variables['volume_iops'] = str(pio_max)
-    variables['ebs_optimized'] = ebs_optimized_supported(variables['instance_type'])
 
-    # pick up the first key with a description containing spilo
-    kms_keys = [k for k in list_kms_keys(region.Region)
-                if 'alias/aws/ebs' not in k['aliases'] and 'spilo' in ((k['Description']).lower())]
+def prepare_pooler(variables):
+    """
+        The settings of the connection pooler, which takes the connections of the clients on pooler_port
+        in place of PostgreSQL: the load balancers forward to it, while their health checks still ask
+        Patroni for the role of the member. Taupage runs a single container, so the image itself has to
+        start PgBouncer from the PGBOUNCER_* variables. The Spilo images do not, and with them nothing
+        would listen on pooler_port, so the image has to be one of pooler_images.
+
+    >>> variables = prepare_pooler(set_default_variables({'use_pooler': True, 'pooler_mode': 'session',
+    ...                                                   'docker_image': 'registry.example.com/spilo-pgbouncer:1.0',
+    ...                                                   'pooler_images': 'registry.example.com/spilo-pgbouncer'}))
+    >>> variables['instance_port'], [(s['name'], s['value']) for s in variables['pooler_settings']][:3]
+    (6432, [('PGBOUNCER_PORT', '6432'), ('PGBOUNCER_POOL_MODE', 'session'), ('PGBOUNCER_DEFAULT_POOL_SIZE', '8')])
+    """
+    image = variables['docker_image']
+    images = [i.strip() for i in (variables['pooler_images'] or '').split(',') if i.strip()]
+    if isinstance(image, LazyDefault) or get_image_repository(image) not in images:
+        fatal_error("use_pooler needs a docker_image that runs PgBouncer from the PGBOUNCER_* environment variables, "
+                    "listed in pooler_images; the Spilo images do not run it")
+    if variables['pooler_mode'] and variables['pooler_mode'] not in POOL_MODES:
+        fatal_error("pooler_mode should be one of {0}".format(', '.join(POOL_MODES)))
+    if variables['pooler_pool_size'] and int(variables['pooler_pool_size']) <= 0:
+        fatal_error("pooler_pool_size should be a positive number")
+    if str(variables['pooler_port']) in (str(variables['postgres_port']), str(variables['healthcheck_port'])):
+        fatal_error("pooler_port should differ from postgres_port and healthcheck_port")
+    resolve_variable(variables, 'instance_port')
+    resolve_variable(variables, 'pooler_settings')
+    return variables
 
-    if len(kms_keys) == 0:
-        raise fatal_error('No KMS key is available for encrypting and decrypting. '
-                          'Ensure you have at least 1 key available.')
 
-    kms_key = kms_keys[0]
-    kms_keyid = kms_key['KeyId']
-    variables['kms_arn'] = kms_key['Arn']
+def get_image_repository(image):
+    """
+    >>> get_image_repository('registry.example.com:5000/acid/spilo-9.6:1.1-p5')
+    'registry.example.com:5000/acid/spilo-9.6'
+    """
+    repository = image.split('@')[0]
+    if ':' in repository.rsplit('/', 1)[-1]:
+        repository = repository.rsplit(':', 1)[0]
+    return repository
+
+
+def get_instance_port(use_pooler, postgres_port, pooler_port):
+    return pooler_port if use_pooler else postgres_port
 
-    for key in [k for k in variables if k.startswith('pgpassword_')]:
-        encrypted = encrypt(region=region.Region, KeyId=kms_keyid, Plaintext=variables[key], b64encode=True)
-        variables[key] = 'aws:kms:{}'.format(encrypted)
 
-    check_s3_bucket(variables['wal_s3_bucket'], region.Region)
+def get_pooler_settings(use_pooler, pooler_port, instance_type, postgresql_parameters, pooler_mode, pooler_pool_size):
+    """ The PgBouncer settings as the environment variables of the container, empty without use_pooler """
+    if not use_pooler:
+        return []
+    max_connections = (postgresql_parameters or {}).get('max_connections')
+    settings = OrderedDict([('port', pooler_port)])
+    settings.update(tune_pooler(instance_type, max_connections, pooler_mode, pooler_pool_size))
+    return [{'name': 'PGBOUNCER_' + name.upper(), 'value': str(value)} for name, value in settings.items()]
 
-    if variables['use_spot_instances'] and variables['spot_price'] == 0:
+
+def get_block_devices(use_ebs, instance_type, volume_count, volume_size, volume_type, volume_iops):
+    if not use_ebs:
+        return [device._asdict() for device in plan_instance_store(instance_type)]
+    return [volume._asdict() for volume in plan_volumes(int(volume_count), volume_size, volume_type, volume_iops)]
+
+
+def get_raid_device(block_devices):
+    return RAID_DEVICE if len(block_devices) > 1 else None
+
+
+def get_data_partition(block_devices, raid_device):
+    return raid_device or block_devices[0]['partition']
+
+
+def get_environment_key(variables):
+    """ The variables that determine the results of the tasks from get_environment_tasks """
+    return tuple(variables[name] for name in ('team_region', 'hosted_zone', 'team_gateway_zone',
+                                              'team_regions', 'team_availability_zones'))
+
+
+def get_environment_tasks(variables, region, scope=''):
+    """
+        Discovery tasks for the account, region and team zones of the cluster, the results of which
+        are the same for all clusters with the same get_environment_key. The task names are prefixed
+        with the scope. The results are taken from the discovery cache while they are fresh, the cached
+        results of the kind in invalidate_cache, or of all kinds, are dropped first.
+    """
+    cache = get_discovery_cache(region, is_true(variables['refresh_cache']))
+    if variables['invalidate_cache']:
+        cache.invalidate(None if variables['invalidate_cache'] == 'all' else variables['invalidate_cache'])
+    team_regions, availability_zones = get_team_regions(variables)
+    lookups = [
+        # pick up the proper etcd address depending on the region
+        ('discovery_domain', detect_etcd_discovery_domain_for_region, (variables['hosted_zone'], region)),
+        # get the IP addresses of the NAT gateways to acess a given ELB.
+        ('nat_gateway_addresses', detect_eu_team_nat_gateways,
+         (variables['team_gateway_zone'], team_regions, availability_zones)),
+        ('odd_instance_addresses', detect_eu_team_odd_instances, (variables['team_gateway_zone'], team_regions)),
+        ('security_groups', detect_security_groups, (region, [ODD_SG_GROUP_NAME_REGEX, ZMON_SG_GROUP_NAME_REGEX])),
+        ('kms_key', detect_kms_key, (region,)),
+    ]
+    # only the name of the bucket is cached, a bucket deleted in the meantime is created again
+    return [DiscoveryTask(scope + 'wal_s3_bucket', detect_wal_s3_bucket, (region, cache))] + \
+        [DiscoveryTask(scope + name, cache.cached, (name, function) + args) for name, function, args in lookups]
+
+
+def get_cluster_tasks(variables, region, scope='', environment_scope=''):
+    """
+        Discovery tasks specific to the cluster, the task names are prefixed with the scope. The
+        tasks depend on the results of get_environment_tasks named with the environment_scope.
+    """
+    generate_missing_passwords(variables)
+    tasks = [DiscoveryTask(scope + key, encrypt_secret, (region, variables[key]),
+                           requires=(environment_scope + 'kms_key',))
+             for key in sorted(k for k in variables if k.startswith('pgpassword_'))]
+    if needs_spot_bid(variables):
+        tasks.append(DiscoveryTask(scope + 'on_demand_price', get_on_demand_price,
+                                   (DeferredAction(), variables['team_region'], variables['instance_type'])))
+    return tasks
+
+
+def needs_spot_bid(variables):
+    return bool(variables['use_spot_instances']) and variables['spot_price'] == 0
+
+
+def get_spot_price_tasks(clusters, region, scope=''):
+    """
+        Discovery task for the spot price history of the instance types of all the clusters in the
+        region that need a bid, fetched at once. The task name is prefixed with the scope.
+    """
+    clusters = [variables for variables in clusters if needs_spot_bid(variables)]
+    if not clusters:
+        return []
+    instance_types = tuple(sorted(set(variables['instance_type'] for variables in clusters)))
+    days = max(int(variables['spot_price_history_days']) for variables in clusters)
+    return [DiscoveryTask(scope + 'spot_price_history', get_spot_price_history,
+                          (region, instance_types, days, time.time()))]
+
+
+def get_spot_price_history(region, instance_types, days, end):
+    """ The end of the history and the SpotPriceHistory of each instance type in the days before it """
+    end_time = datetime.datetime.utcfromtimestamp(end)
+    start_time = end_time - datetime.timedelta(days=days)
+    return end, load_spot_price_history(get_client('ec2', region), instance_types, start_time, end_time)
+
+
+def apply_discovery_results(variables, results, scope='', environment_scope=''):
+    """ Set the variables from the results of get_environment_tasks and get_cluster_tasks """
+    for name in ('wal_s3_bucket', 'discovery_domain', 'nat_gateway_addresses', 'odd_instance_addresses'):
+        variables[name] = results[environment_scope + name]
+    security_groups = results[environment_scope + 'security_groups']
+    variables['odd_sg_id'] = security_groups[ODD_SG_GROUP_NAME_REGEX]
+    variables['zmon_sg_id'] = security_groups[ZMON_SG_GROUP_NAME_REGEX]
+    variables['kms_arn'] = results[environment_scope + 'kms_key']['Arn']
+    for key in [k for k in variables if k.startswith('pgpassword_')]:
+        variables[key] = results[scope + key]
+
+    rules = generate_spilo_master_security_group_ingress(variables['nat_gateway_addresses'] +
+                                                         variables['odd_instance_addresses'])
+    limit = int(variables['security_group_rules_limit'])
+    for name, group_name in (('spilo_master_security_groups', 'SpiloMasterSG'),
+                             ('spilo_replica_security_groups', 'SpiloReplicaSG')):
+        variables[name] = plan_security_groups(group_name, rules, limit)
+        if len(variables[name]) > LOAD_BALANCER_SECURITY_GROUPS_LIMIT:
+            fatal_error("{0} ingress rules need {1} security groups of {2} rules, a load balancer can only have {3}".
+                        format(len(rules), len(variables[name]), limit, LOAD_BALANCER_SECURITY_GROUPS_LIMIT))
+
+    on_demand_price = results.get(scope + 'on_demand_price')
+    if on_demand_price is not None:
+        from clickclick import Action
         with Action("Calculating the maximum spot price for {0}..".format(variables['instance_type'])) as act:
-            on_demand_price = get_on_demand_price(act, variables['team_region'], variables['instance_type'])
-            if on_demand_price == 0:
+            analysis = get_spot_analysis(variables, results.get(environment_scope + 'spot_price_history'),
+                                         on_demand_price or None)
+            if analysis.bid is not None:
+                variables['spot_price'] = analysis.bid
+                if analysis.bid == on_demand_price:
+                    act.warning("the {0}th percentile of the spot price is above the on-demand price, bidding "
+                                "the on-demand price".format(variables['spot_price_percentile']))
+            elif on_demand_price == 0:
                 act.fatal_error("Could not get the correct on-demand price, try running without use_spot_instances")
             else:
+                # no spot market history for the instance type
                 variables['spot_price'] = on_demand_price * 1.2
 
     return variables
 
 
+def get_spot_analysis(variables, spot_price_history, maximum_bid=None):
+    """
+        Bid for the instance type of the cluster at the spot_price_percentile of its history over
+        the last spot_price_history_days, and the statistics of each availability zone
+    """
+    end, histories = spot_price_history or (0, {})
+    history = histories.get(variables['instance_type'])
+    if history is None:
+        return SpotAnalysis(None, [])
+    start = end - int(variables['spot_price_history_days']) * SECONDS_PER_DAY
+    return analyze_spot_prices(history, start, end, float(variables['spot_price_percentile']), maximum_bid)
+
+
+def fatal_error(msg, **kwargs):
+    """
+        clickclick.fatal_error, clickclick is only imported once it is needed, same as all heavy
+        dependencies: senza imports the template whenever it lists or loads the templates.
+
+    >>> import subprocess, sys
+    >>> root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    >>> code = ('import sys; loaded = set(sys.modules); import acid.senza.templates.base; '
+    ...         'print(" ".join(set(sys.modules) - loaded))')
+    >>> imported = subprocess.run([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE,
+    ...                           universal_newlines=True, check=True).stdout.split()
+    >>> [dependency for dependency in ('boto3', 'botocore', 'requests', 'urllib3', 'dns', 'clickclick', 'click',
+    ...                                'senza', 'pystache', 'yaml', 'concurrent.futures', 'multiprocessing')
+    ...  if any(name == dependency or name.startswith(dependency + '.') for name in imported)]
+    []
+    """
+    from clickclick import fatal_error
+    fatal_error(msg, **kwargs)
+
+
+def warning(msg, **kwargs):
+    """ clickclick.warning, imported once it is needed """
+    from clickclick import warning
+    warning(msg, **kwargs)
+
+
+class DiscoveryError(Exception):
+    """ Failure of one of the discovery functions, reported with fatal_error by gather_user_variables """
+
+
+class DeferredAction:
+    """ Stand-in for clickclick.Action in the functions that run concurrently, raising errors instead of exiting """
+
+    def fatal_error(self, msg, **kwargs):
+        raise DiscoveryError(msg)
+
+
+DiscoveryTask = namedtuple('DiscoveryTask', 'name function args requires')
+DiscoveryTask.__new__.__defaults__ = ((),)
+
+
+def run_discovery(tasks, max_workers=DISCOVERY_WORKERS):
+    """
+        Run the discovery tasks concurrently and return their results by task name. A task starts
+        as soon as all tasks named in its requires are done, their results are passed after its own
+        arguments. Once all tasks are finished, the error of the first failed task in the list is
+        raised, so that the errors are reported in the same order regardless of the timing.
+
+    >>> run_discovery([DiscoveryTask('a', int, ('1',)), DiscoveryTask('b', pow, (2,), requires=('a',))])
+    {'a': 1, 'b': 2}
+    >>> run_discovery([DiscoveryTask('a', int, ('x',)), DiscoveryTask('b', int, ('1',), requires=('a',))])
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    results = {}
+    errors = {}
+    pending = list(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for task in list(pending):
+                if any(r in errors for r in task.requires):
+                    pending.remove(task)
+                    errors[task.name] = None
+                elif all(r in results for r in task.requires):
+                    pending.remove(task)
+                    args = tuple(task.args) + tuple(results[r] for r in task.requires)
+                    running[executor.submit(run_discovery_task, task, args)] = task
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                if future.exception() is not None:
+                    errors[task.name] = future.exception()
+                else:
+                    results[task.name] = future.result()
+    for task in tasks:
+        if errors.get(task.name) is not None:
+            raise errors[task.name]
+    return results
+
+
+def run_discovery_task(task, args):
+    """ Result of the task, traced as a span named after the task, without the scope """
+    scope, _, name = task.name.rpartition('/')
+    with trace.span(name, scope=scope):
+        return task.function(*args)
+
+
 def check_dns_name(name, hosted_zone):
     """
     >>> check_dns_name('foo.bar.example.com')
@@ -531,39 +1042,204 @@ def generate_random_password(length=64):
     >>> len(generate_random_password(61))
     61
     """
-    return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(length))
+    return generate_random_passwords(1, length)[0]
+
+
+def generate_random_passwords(count, length=64):
+    """
+        Generate count passwords from a single read of the system entropy source.
+
+    >>> [len(p) for p in generate_random_passwords(3, 61)]
+    [61, 61, 61]
+    >>> set(''.join(generate_random_passwords(10))) <= set(PASSWORD_ALPHABET)
+    True
+    """
+    needed = count * length
+    chars = b''
+    while len(chars) < needed:
+        # bytes not mapping evenly to the alphabet are dropped, so that all characters are equally likely
+        chars += os.urandom(needed + needed // 16 + 16).translate(_password_table, _password_rejected_bytes)
+    chars = chars[:needed].decode('ascii')
+    return [chars[i:i + length] for i in range(0, needed, length)]
+
+
+def generate_missing_passwords(variables):
+    """ Generate the passwords that are not set yet, all at once """
+    names = [k for k in sorted(variables) if k.startswith('pgpassword_') and isinstance(variables[k], LazyDefault)]
+    for name, password in zip(names, generate_random_passwords(len(names))):
+        variables[name] = password
 
 
 def generate_definition(variables):
     """
-    >>> variables = set_default_variables(dict())
+    >>> groups = plan_security_groups('SpiloMasterSG', generate_spilo_master_security_group_ingress(['10.0.0.1']))
+    >>> variables = set_default_variables({'docker_image': SPILO_IMAGE_ADDRESS + ':1.0',
+    ...                                    'spilo_master_security_groups': groups})
     >>> len(generate_definition(variables)) > 300
     True
     """
-    definition_yaml = pystache_render(TEMPLATE, variables)
+    with trace.span('resolve_variables'):
+        resolve_variables(variables)
+    import pystache
+    with trace.span('generate_definition'):
+        definition_yaml = pystache.Renderer(missing_tags='strict').render(get_parsed_template(), variables)
     return definition_yaml
 
 
+def generate_definitions(variable_sets, processes=None):
+    """
+        Render the definitions for a list of variable sets, in the same order. With processes,
+        the rendering is spread over a pool of that many worker processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not processes:
+        return [generate_definition(variables) for variables in variable_sets]
+    # the defaults are computed here, so that they are computed only once and are not lost in the workers
+    for variables in variable_sets:
+        resolve_variables(variables)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunksize = max(1, len(variable_sets) // (processes * 4))
+        return list(executor.map(generate_definition, variable_sets, chunksize=chunksize))
+
+
+def get_parsed_template():
+    """ The TEMPLATE parsed by pystache, parsing takes most of the rendering time, thus, it is only done once """
+    global _parsed_template
+    if _parsed_template is None:
+        import pystache
+        _parsed_template = pystache.parse(TEMPLATE)
+    return _parsed_template
+
+
 def generate_spilo_master_security_group_ingress(addresses_to_allow):
-    result = ""
-    for addr in addresses_to_allow:
-        if addr != addresses_to_allow[0]:
-            result += '\n'+' ' * 8
-        result += "- IpProtocol: tcp{delim}FromPort: {port}{delim}ToPort: {port}{delim}CidrIp: {ip}/32".\
-                  format(port=POSTGRES_PORT, ip=addr, delim='\n' + ' ' * 10)
-    return result
+    """
+        Ingress rules of the load balancers for the addresses, or CIDR blocks, to allow. The addresses are
+        deduplicated and collapsed into the smallest set of CIDR blocks covering all of them.
+
+    >>> [r['CidrIp'] for r in generate_spilo_master_security_group_ingress(
+    ...     ['10.0.0.1', '10.0.0.0', '10.0.0.1', '10.0.0.2', '10.1.0.0/16', '10.1.2.3'])]
+    ['10.0.0.0/31', '10.0.0.2/32', '10.1.0.0/16']
+    """
+    import ipaddress
+
+    networks = ipaddress.collapse_addresses(ipaddress.ip_network(address, strict=False)
+                                            for address in addresses_to_allow)
+    return [{'IpProtocol': 'tcp', 'FromPort': POSTGRES_PORT, 'ToPort': POSTGRES_PORT, 'CidrIp': str(network)}
+            for network in networks]
+
+
+def plan_security_groups(name, rules, limit=SECURITY_GROUP_RULES_LIMIT):
+    """
+        Split the ingress rules over as few security groups as possible with at most limit rules each,
+        the first one named name, the following ones name2, name3 and so on.
+
+    >>> [(g['name'], len(g['rules'])) for g in plan_security_groups('SpiloMasterSG', list(range(130)))]
+    [('SpiloMasterSG', 60), ('SpiloMasterSG2', 60), ('SpiloMasterSG3', 10)]
+    """
+    shards = [rules[start:start + limit] for start in range(0, len(rules), limit)] or [[]]
+    return [{'name': name + (str(number) if number > 1 else ''),
+             'description_suffix': ' (part {0})'.format(number) if number > 1 else '',
+             'rules': shard} for number, shard in enumerate(shards, 1)]
+
+
+def parse_postgresql_configuration(postgresqlconf):
+    """
+        The PostgreSQL parameters of the postgresql_conf variable, {name: value, ...}, in their order.
+        Values with commas, or leading or trailing spaces, are quoted with single or double quotes.
+
+    >>> list(parse_postgresql_configuration("{shared_buffers: 1GB, log_line_prefix: '%t:%p '}").items())
+    [('shared_buffers', '1GB'), ('log_line_prefix', '%t:%p ')]
+    >>> parse_postgresql_configuration('{search_path: "$user, public"}')['search_path']
+    '$user, public'
+    """
+    text = postgresqlconf.strip()
+    if text.startswith('{') and text.endswith('}'):
+        text = text[1:-1]
+    parameters = OrderedDict()
+    position = 0
+    while position < len(text):
+        match = _postgresql_parameter.match(text, position)
+        if not match:
+            fatal_error("Invalid PostgreSQL configuration at: {0}".format(text[position:]))
+        if match.group('double') is not None:
+            value = json.loads('"{0}"'.format(match.group('double')))
+        elif match.group('single') is not None:
+            value = match.group('single').replace("''", "'")
+        else:
+            value = match.group('plain')
+        parameters[match.group('name')] = value
+        position = match.end()
+    return parameters
+
+
+def format_postgresql_parameters(parameters):
+    """
+        The parameters as lines of the parameters section of PATRONI_CONFIGURATION in TEMPLATE. The
+        values that would not be read back unchanged as plain scalars are double-quoted, TEMPLATE
+        inserts the lines unescaped so that pystache leaves the quotes alone.
+
+    >>> print(format_postgresql_parameters(OrderedDict([('work_mem', '16MB'), ('log_line_prefix', '%t:%p '),
+    ...                                                 ('search_path', '"$user", public')])))
+    work_mem:  16MB
+                        log_line_prefix:  "%t:%p "
+                        search_path:  "\\"$user\\", public"
+    """
+    return ('\n' + ' ' * 20).join('{0}:  {1}'.format(name, format_postgresql_value(value))
+                                  for name, value in parameters.items())
+
+
+def format_postgresql_value(value):
+    value = str(value)
+    # a JSON string is a valid double-quoted YAML scalar
+    return value if is_plain(value) else json.dumps(value, ensure_ascii=False)
+
+
+def is_plain(text):
+    """
+        Whether the text can be written as a plain YAML scalar and read back as a single scalar that
+        keeps the text, if a string, unchanged
+
+    >>> [is_plain(t) for t in ('3', 'on', 'HTTP:8008/master', 'a: b', '%t:%p ', '"$user", public')]
+    [True, True, True, False, False, False]
+    """
+    import yaml
+
+    if not text or '\n' in text or text != text.strip():
+        return False
+    try:
+        value = yaml.safe_load(text)
+    except yaml.YAMLError:
+        return False
+    return not isinstance(value, (dict, list)) and (not isinstance(value, str) or value == text)
+
+
+def get_tuned_parameters(variables, max_connections=None):
+    """
+        The PostgreSQL parameters for the instance type and volume, with the parallel query settings
+        the version of PostgreSQL in the image supports. Without an explicit image, that is the version
+        of the default one, which does not need to be looked up for that.
+
+    >>> parameters = get_tuned_parameters(set_default_variables({'instance_type': 'r4.xlarge'}))
+    >>> parameters['shared_buffers'], parameters['effective_cache_size'], 'max_parallel_workers' in parameters
+    ('7808MB', '23424MB', False)
+    """
+    image = variables['docker_image']
+    if isinstance(image, LazyDefault):
+        image = SPILO_IMAGE_ADDRESS
+    store = INSTANCE_STORES.get(variables['instance_type'])
+    if variables['use_ebs']:
+        storage, volume_size = get_storage_kind(variables['volume_type']), variables['volume_size']
+    elif store:
+        storage, volume_size = 'hdd' if store.kind == 'hdd' else 'ssd', store.count * store.size
+    else:
+        storage, volume_size = 'ssd', None
+    return tune_postgresql(variables['instance_type'], storage, volume_size, get_postgresql_version(image),
+                           max_connections)
 
 
-# we cannot use the JSON form {'name': value}, since pystache manges the quotes.
 def generate_postgresql_configuration(postgresqlconf):
-    result = ""
-    options = [t.strip() for t in postgresqlconf.strip('{}').split(',')]
-    for opt in options:
-        if opt != options[0]:
-            result += '\n' + ' ' * 20
-        key, value = opt.split(':', 2)
-        result += "{0}:  {1}".format(key.strip(), value.strip())
-    return result
+    return format_postgresql_parameters(parse_postgresql_configuration(postgresqlconf))
 
 
 def get_latest_image(registry_domain='registry.opensource.zalan.do', team='acid', artifact='spilo-9.5'):
@@ -574,11 +1250,13 @@ def get_latest_image(registry_domain='registry.opensource.zalan.do', team='acid'
     ''
     """
     try:
-        r = requests.get('https://{0}/teams/{1}/artifacts/{2}/tags'.format(registry_domain, team, artifact))
-        if r.ok:
+        with trace.span('get_latest_image'):
+            tags = http.get_cached_json(REGISTRY_TAGS_URL.format(registry=registry_domain, team=team,
+                                                                 artifact=artifact), get_cache_dir())
+        if tags:
             # sort the tags by creation date
             latest = None
-            for entry in sorted(r.json(), key=lambda t: t['created'], reverse=True):
+            for entry in sorted(tags, key=lambda t: t['created'], reverse=True):
                 tag = entry['name']
                 # try to avoid snapshots if possible
                 if 'SNAPSHOT' not in tag:
@@ -591,83 +1269,226 @@ def get_latest_image(registry_domain='registry.opensource.zalan.do', team='acid'
     return ""
 
 
-def get_records_for_hosted_zone(zone_name):
-    route53 = boto3.client('route53')
-    zones = route53.list_hosted_zones_by_name()
-    zone_id = None
+def get_hosted_zone_id(route53, zone_name):
+    """ Id of the hosted zone with the given name, looked up once per process """
+    if zone_name not in _hosted_zone_ids:
+        zones = route53.list_hosted_zones_by_name(DNSName=zone_name, MaxItems='1')['HostedZones']
+        _hosted_zone_ids[zone_name] = zones[0]['Id'] if zones and zones[0]['Name'] == zone_name else None
+    return _hosted_zone_ids[zone_name]
+
+
+def get_records_for_hosted_zone(zone_name, record_name=None, record_type=None):
+    """
+        List the record sets of the hosted zone, following the pagination. If record_name is given,
+        only the record sets with that name (and record_type, if given) are fetched. Returns None if
+        the zone does not exist.
+    """
+    route53 = get_client('route53')
+    zone_id = get_hosted_zone_id(route53, zone_name)
+    if not zone_id:
+        return None
+    return list_record_sets(route53, zone_id, record_name, record_type)
+
 
-    for z in zones['HostedZones']:
-        if z['Name'] == zone_name:
-            zone_id = z['Id']
-            break
-    return route53.list_resource_record_sets(HostedZoneId=zone_id) if zone_id else []
+def list_record_sets(route53, zone_id, record_name=None, record_type=None):
+    """
+        The record sets of the hosted zone with the id, or only the ones with record_name (and
+        record_type), the pages of which are requested until a record set with another name follows
+
+    >>> class Route53:
+    ...     def __init__(self, pages):
+    ...         self.pages = iter(pages)
+    ...     def list_resource_record_sets(self, **params):
+    ...         print(sorted(params.items()))
+    ...         return next(self.pages)
+    >>> pages = [{'ResourceRecordSets': [{'Name': 'b.', 'Type': 'SRV', 'SetIdentifier': '1'}], 'IsTruncated': True,
+    ...           'NextRecordName': 'b.', 'NextRecordType': 'SRV', 'NextRecordIdentifier': '2'},
+    ...          {'ResourceRecordSets': [{'Name': 'b.', 'Type': 'SRV', 'SetIdentifier': '2'},
+    ...                                  {'Name': 'c.', 'Type': 'A'}],
+    ...           'IsTruncated': True, 'NextRecordName': 'd.', 'NextRecordType': 'A'},
+    ...          {'ResourceRecordSets': [{'Name': 'd.', 'Type': 'A'}], 'IsTruncated': False}]
+    >>> [r['Name'] for r in list_record_sets(Route53(pages), 'Z1')]
+    [('HostedZoneId', 'Z1')]
+    [('HostedZoneId', 'Z1'), ('StartRecordIdentifier', '2'), ('StartRecordName', 'b.'), ('StartRecordType', 'SRV')]
+    [('HostedZoneId', 'Z1'), ('StartRecordName', 'd.'), ('StartRecordType', 'A')]
+    ['b.', 'b.', 'c.', 'd.']
+    >>> [r['SetIdentifier'] for r in list_record_sets(Route53(pages), 'Z1', 'b.', 'SRV')]
+    [('HostedZoneId', 'Z1'), ('StartRecordName', 'b.'), ('StartRecordType', 'SRV')]
+    [('HostedZoneId', 'Z1'), ('StartRecordIdentifier', '2'), ('StartRecordName', 'b.'), ('StartRecordType', 'SRV')]
+    ['1', '2']
+    """
+    params = {'HostedZoneId': zone_id}
+    if record_name:
+        params['StartRecordName'] = record_name
+        if record_type:
+            params['StartRecordType'] = record_type
+    records = []
+    while True:
+        response = route53.list_resource_record_sets(**params)
+        for r in response['ResourceRecordSets']:
+            # record sets are sorted by name and type, the ones we are looking for come first
+            if record_name and (r['Name'] != record_name or (record_type and r['Type'] != record_type)):
+                return records
+            records.append(r)
+        if not response['IsTruncated']:
+            return records
+        params['StartRecordName'] = response['NextRecordName']
+        params['StartRecordType'] = response['NextRecordType']
+        if 'NextRecordIdentifier' in response:
+            params['StartRecordIdentifier'] = response['NextRecordIdentifier']
+        else:
+            params.pop('StartRecordIdentifier', None)
 
 
 def detect_etcd_discovery_domain_for_region(dbaas_zone, user_region):
     """ Query DNS zone for the etcd record corresponding to a given region. """
     user_region = user_region.split('-')[1]  # leave only 'west' out of 'eu-west-1'
-    records = get_records_for_hosted_zone(dbaas_zone)
-    if not records:
-        fatal_error("Unable to list records for {0}: make sure you are logged into the DBaaS account".
-                    format(dbaas_zone))
-    for r in records['ResourceRecordSets']:
-        if r['Type'] == 'SRV' and r['Name'] == '_etcd._tcp.{region}.{zone}'.format(region=user_region,
-                                                                                   zone=dbaas_zone):
-            return "{region}.{zone}".format(region=user_region,
-                                            zone=dbaas_zone[:-1])
+    record_name = '_etcd._tcp.{region}.{zone}'.format(region=user_region, zone=dbaas_zone)
+    records = get_records_for_hosted_zone(dbaas_zone, record_name, 'SRV')
+    if records is None:
+        raise DiscoveryError("Unable to list records for {0}: make sure you are logged into the DBaaS account".
+                             format(dbaas_zone))
+    if records:
+        return "{region}.{zone}".format(region=user_region,
+                                        zone=dbaas_zone[:-1])
     return None
 
 
-def detect_eu_team_nat_gateways(team_zone_name):
+def resolve_team_hosts(names):
+    """
+        The addresses of each of the names. A name that timed out fails the discovery: leaving its
+        addresses out would silently block the hosts behind it in the security groups.
+    """
+    try:
+        return get_resolver().query_all(names)
+    except DNSTimeout as e:
+        raise DiscoveryError(str(e))
+
+
+def detect_eu_team_nat_gateways(team_zone_name, regions=TEAM_REGIONS, availability_zones=TEAM_AVAILABILITY_ZONES):
     """
         Detect NAT gateways. Since the complete zone is not hosted by DBaaS and
         not accessible, try to figure out individual NAT endpoints by name.
     """
-    resolver = dns.resolver.Resolver()
-    nat_gateways = []
-    for region in ('eu-west-1', 'eu-central-1'):
-        for az in ('a', 'b', 'c'):
-            try:
-                answer = resolver.query('nat-{region}{az}.{zone}'.
-                                        format(region=region, az=az, zone=team_zone_name), 'A')
-                nat_gateways.extend(str(rdata) for rdata in answer)
-            except dns.resolver.NXDOMAIN:
-                continue
+    names = ['nat-{region}{az}.{zone}'.format(region=region, az=az, zone=team_zone_name)
+             for region in regions for az in availability_zones]
+    nat_gateways = [address for answer in resolve_team_hosts(names) for address in answer]
     if not nat_gateways:
-        fatal_error("Unable to detect nat gateways: make sure {0} account is set up correctly".format(team_zone_name))
+        raise DiscoveryError("Unable to detect nat gateways: make sure {0} account is set up correctly".
+                             format(team_zone_name))
     return nat_gateways
 
 
-def detect_eu_team_odd_instances(team_zone_name):
+def detect_eu_team_odd_instances(team_zone_name, regions=TEAM_REGIONS):
     """
       Detect the odd instances by name. Same reliance on a convention as with
       the detect_eu_team_nat_gateways.
     """
-    resolver = dns.resolver.Resolver()
-    odd_hosts = []
-    for region in ('eu-west-1', 'eu-central-1'):
-        try:
-            answer = resolver.query('odd-{region}.{zone}'.format(region=region, zone=team_zone_name))
-            odd_hosts.extend(str(rdata) for rdata in answer)
-        except dns.resolver.NXDOMAIN:
-            continue
-
+    names = ['odd-{region}.{zone}'.format(region=region, zone=team_zone_name) for region in regions]
+    odd_hosts = [address for answer in resolve_team_hosts(names) for address in answer]
     if not odd_hosts:
-        fatal_error("Unable to detect odd hosts: make sure {0} account is set up correctly".format(team_zone_name))
+        raise DiscoveryError("Unable to detect odd hosts: make sure {0} account is set up correctly".
+                             format(team_zone_name))
     return odd_hosts
 
 
+def get_team_regions(variables):
+    """
+    >>> get_team_regions({'team_regions': 'eu-west-1, eu-central-1', 'team_availability_zones': 'a,b'})
+    (['eu-west-1', 'eu-central-1'], ['a', 'b'])
+    """
+    return ([r.strip() for r in variables['team_regions'].split(',') if r.strip()],
+            [az.strip() for az in variables['team_availability_zones'].split(',') if az.strip()])
+
+
+def get_wal_s3_bucket_name(region):
+    return '{}-{}-spilo-dbaas'.format(get_account_alias(), region)
+
+
+def detect_wal_s3_bucket(region, cache):
+    """
+        Name of the bucket for the WAL archive in the current account, creating the bucket if necessary.
+        The name is taken from the discovery cache, but the bucket is checked every time.
+    """
+    wal_s3_bucket = cache.cached('wal_s3_bucket', get_wal_s3_bucket_name, region)
+    check_s3_bucket(wal_s3_bucket, region)
+    return wal_s3_bucket
+
+
+def detect_kms_key(region):
+    """ Pick up the first key with a description containing spilo """
+    kms_keys = [k for k in list_kms_keys(region)
+                if 'alias/aws/ebs' not in k['aliases'] and 'spilo' in ((k['Description']).lower())]
+
+    if len(kms_keys) == 0:
+        raise DiscoveryError('No KMS key is available for encrypting and decrypting. '
+                             'Ensure you have at least 1 key available.')
+    return kms_keys[0]
+
+
+def encrypt_secret(region, plaintext, kms_key):
+    return 'aws:kms:{}'.format(encrypt(region, kms_key['KeyId'], plaintext))
+
+
 def detect_security_group(region, sg_regex):
-    ec2 = boto3.client('ec2', region)
+    return detect_security_groups(region, [sg_regex])[sg_regex]
+
+
+def detect_security_groups(region, sg_regexes):
+    """
+        Find the id of the only security group with the name matching each of the regular expressions,
+        listing the security groups only once. The listing is narrowed down by the group name on the
+        server side when all regular expressions start with a literal prefix.
+    """
+    ec2 = get_client('ec2', region)
+
+    params = {}
+    name_filters = [security_group_name_filter(sg_regex) for sg_regex in sg_regexes]
+    if all(name_filters):
+        params['Filters'] = [{'Name': 'group-name', 'Values': sorted(set(name_filters))}]
+    if ec2.can_paginate('describe_security_groups'):
+        pages = ec2.get_paginator('describe_security_groups').paginate(**params)
+    else:
+        pages = [ec2.describe_security_groups(**params)]
 
-    sgs = [sg for sg in ec2.describe_security_groups()['SecurityGroups'] if re.match(sg_regex, sg['GroupName'])]
+    patterns = [(sg_regex, re.compile(sg_regex)) for sg_regex in sg_regexes]
+    sgs = {sg_regex: [] for sg_regex in sg_regexes}
+    for page in pages:
+        for sg in page['SecurityGroups']:
+            for sg_regex, pattern in patterns:
+                if pattern.match(sg['GroupName']):
+                    sgs[sg_regex].append(sg['GroupId'])
 
-    if len(sgs) == 0:
-        fatal_error('Could not find security group which matches regex {}'.format(sg_regex))
-    if len(sgs) > 1:
-        fatal_error('More than one security group found for regex {}'.format(sg_regex))
+    for sg_regex in sg_regexes:
+        if len(sgs[sg_regex]) == 0:
+            raise DiscoveryError('Could not find security group which matches regex {}'.format(sg_regex))
+        if len(sgs[sg_regex]) > 1:
+            raise DiscoveryError('More than one security group found for regex {}'.format(sg_regex))
 
-    return sgs[0]['GroupId']
+    return {sg_regex: ids[0] for sg_regex, ids in sgs.items()}
+
+
+def security_group_name_filter(sg_regex):
+    """
+        Wildcard for the group-name filter of describe_security_groups matching all names that
+        start with the literal prefix of the regular expression, None if it has no such prefix.
+
+    >>> security_group_name_filter('Odd.*')
+    'Odd*'
+    >>> security_group_name_filter('app-zmon-db')
+    'app-zmon-db*'
+    >>> security_group_name_filter('app-zmon-dbs?')
+    'app-zmon-db*'
+    >>> security_group_name_filter('odd|zmon') is None
+    True
+    """
+    if '|' in sg_regex:
+        return None
+    prefix = re.match(r'[\w\- ]*', sg_regex).group()
+    # a quantifier after the prefix applies to its last character
+    if sg_regex[len(prefix):len(prefix) + 1] in ('?', '*', '{'):
+        prefix = prefix[:-1]
+    return prefix + '*' if prefix else None
 
 
 def get_on_demand_price(act, region, instance_type):
@@ -675,41 +1496,137 @@ def get_on_demand_price(act, region, instance_type):
         Calculate prices on demand for a given region and instance type
         Fetch the SKU of the desired on-demand instance from AWS API,
         then use the SKU to fetch the acutal price.
-        XXX: the API returns a json of 45MB, takes long to parse
+        The API returns a JSON document of several hundred MB, therefore,
+        the prices are looked up in the local price index, unless it is
+        disabled, in which case the document is parsed incrementally while
+        being downloaded.
     """
-    if region == 'eu-central-1':
-        region = 'EU (Ireland)'
-    elif region == 'eu-west-1':
-        region = 'EU (Frankfurt)'
-    else:
-        act.fatal_error("Region {0} is not supported for EC2 by this template".format(region))
+    from requests.exceptions import RequestException
+
+    location = get_pricing_location(act, region)
+    if get_price_index_ttl() > 0:
+        price = get_price_index(act).lookup(location, instance_type)
+        if price is None:
+            act.fatal_error("Cannot fetch the price of instance {0}".format(instance_type))
+        return price
+
     try:
-        prices_request = requests.get(PRICE_URL)
-    except RequestException as e:
+        sku, price_object = find_on_demand_offer(get_offer_file_chunks(), location, instance_type)
+    except (RequestException, ValueError) as e:
         act.fatal_error("Could not get AWS EC2 pricing API {0}: {1}".format(PRICE_URL, e))
-
-    if prices_request.ok:
-        prices = prices_request.json()
-        for p in prices['products'].values():
-            if (p['productFamily'] == 'Compute Instance' and
-                    p['attributes'].get('location') == region and
-                    p['attributes']['instanceType'] == instance_type and
-                    p['attributes']['operatingSystem'] == 'Linux' and
-                    p['attributes']['tenancy'] == 'Shared'):
-                sku = p['sku']
-                break
-        else:
-            act.fatal_error("Cannot fetch SKU for the price of instance {0}".format(instance_type))
-        price_object = prices['terms']['OnDemand'][sku]
-        if len(price_object) != 1:
-            act.fatal_error("Format error: more than one entry for SKU {0}: {1}".format(sku, price_object))
-        price_dimension = price_object.popitem()[1]['priceDimensions'].popitem()[1]
-        if 'pricePerUnit' in price_dimension:
-            instance_price = price_dimension['pricePerUnit'].get('USD', '0')
-            return float(instance_price)
-        else:
-            act.fatal_error("Unable to find a single instance price for instance {0} sku {1}".format(
-                             instance_type,
-                             sku))
+    if not sku:
+        act.fatal_error("Cannot fetch SKU for the price of instance {0}".format(instance_type))
+    if not price_object:
+        act.fatal_error("Cannot find on-demand terms for SKU {0}".format(sku))
+    if len(price_object) != 1:
+        act.fatal_error("Format error: more than one entry for SKU {0}: {1}".format(sku, price_object))
+    price_dimension = price_object.popitem()[1]['priceDimensions'].popitem()[1]
+    if 'pricePerUnit' in price_dimension:
+        instance_price = price_dimension['pricePerUnit'].get('USD', '0')
+        return float(instance_price)
     else:
-        act.fatal_error("Request to AWS EC2 pricing API {0} did not succeed: {1}".format(PRICE_URL, prices.status_code))
+        act.fatal_error("Unable to find a single instance price for instance {0} sku {1}".format(
+                         instance_type,
+                         sku))
+
+
+def get_on_demand_prices(act, region):
+    """ On-demand prices of all Linux instance types available in a given region, from the local price index """
+    return get_price_index(act).prices(get_pricing_location(act, region))
+
+
+def get_pricing_location(act, region):
+    if region not in EC2_PRICING_LOCATIONS:
+        act.fatal_error("Region {0} is not supported for EC2 by this template".format(region))
+    return EC2_PRICING_LOCATIONS[region]
+
+
+def get_offer_file_chunks():
+    return http.iter_content(http.get(PRICE_URL, stream=True), PRICE_CHUNK_SIZE)
+
+
+def fetch_offer_file(validators=None):
+    """ Chunks and validators of the offer file, None if it has not changed since the one with the validators """
+    response = http.get(PRICE_URL, validators, stream=True)
+    if validators and response.status_code == 304:
+        response.close()
+        return None
+    return http.iter_content(response, PRICE_CHUNK_SIZE), http.get_validators(response)
+
+
+def get_cache_dir():
+    """
+    >>> os.environ['SPILO_CACHE_DIR'] = '/tmp/spilo'
+    >>> get_cache_dir()
+    '/tmp/spilo'
+    >>> del os.environ['SPILO_CACHE_DIR']
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.environ.get('SPILO_CACHE_DIR') or os.path.join(cache_home, 'spilo-template')
+
+
+def get_discovery_cache_ttls():
+    """
+        Maximum age in seconds of each kind of the cached discovery results, overridden by the
+        SPILO_DISCOVERY_TTL_<KIND> environment variables, 0 disables caching the results of the kind.
+
+    >>> os.environ['SPILO_DISCOVERY_TTL_SECURITY_GROUPS'] = '0'
+    >>> get_discovery_cache_ttls()['security_groups']
+    0
+    >>> del os.environ['SPILO_DISCOVERY_TTL_SECURITY_GROUPS']
+    """
+    return {kind: int(os.environ.get('SPILO_DISCOVERY_TTL_' + kind.upper(), ttl))
+            for kind, ttl in DISCOVERY_CACHE_TTLS.items()}
+
+
+def get_discovery_cache(region, refresh=False):
+    """
+        Cache of the discovery results in the account of the current credentials and the region. The
+        account id is remembered for each access key, so that it is only looked up once for new credentials.
+    """
+    key = (region, refresh)
+    with _discovery_caches_lock:
+        if key not in _discovery_caches:
+            ttls = get_discovery_cache_ttls()
+            # the recorded or replayed calls should not depend on what happens to be in the cache
+            credentials = get_snapshot() is None and get_session().get_credentials()
+            if not credentials or not any(ttls.values()):
+                _discovery_caches[key] = DiscoveryCache(None, {})
+            else:
+                accounts = DiscoveryCache(os.path.join(get_cache_dir(), 'discovery', 'accounts.json'),
+                                          {'account_id': ACCOUNT_ID_TTL})
+                account_id = accounts.cached('account_id', lambda access_key: get_account_id(),
+                                             credentials.access_key)
+                path = os.path.join(get_cache_dir(), 'discovery', '{0}-{1}.json'.format(account_id, region))
+                _discovery_caches[key] = DiscoveryCache(path, ttls, refresh)
+        return _discovery_caches[key]
+
+
+def is_true(value):
+    """
+    >>> [is_true(v) for v in (True, 'true', 'Yes', '1', False, None, 'false', '0')]
+    [True, True, True, True, False, False, False, False]
+    """
+    return str(value).lower() in ('true', 'yes', '1')
+
+
+def get_price_index_ttl():
+    """ Maximum age in seconds of the local price index, 0 disables the index """
+    return int(os.environ.get('SPILO_PRICE_INDEX_TTL', PRICE_INDEX_TTL))
+
+
+def get_price_index(act):
+    """ Open the local index of on-demand prices, downloading the offer file if the index has expired """
+    global _price_index
+    from requests.exceptions import RequestException
+
+    with _price_index_lock:
+        if _price_index is None:
+            path = os.path.join(get_cache_dir(), PRICE_INDEX_FILE)
+            try:
+                with trace.span('load_price_index'):
+                    _price_index = load_price_index(path, get_price_index_ttl(), fetch_offer_file)
+            except (OSError, RequestException, ValueError) as e:
+                act.fatal_error("Could not build the price index from AWS EC2 pricing API {0}: {1}".
+                                format(PRICE_URL, e))
+        return _price_index
@@ -0,0 +1,130 @@
+'''
+Generation of the definitions for many Spilo clusters from a single manifest.
+
+The manifest is a YAML document with the variables of each cluster, same as the ones passed
+to senza init with -v, and optionally the variables shared by all clusters:
+
+    defaults:
+      team_region: eu-west-1
+      team_gateway_zone: team.example.com
+      hosted_zone: db.example.com
+    clusters:
+      - name: orders
+        team_name: shop
+        instance_type: r3.large
+      - name: payments
+        team_name: payments
+
+The lookups that only depend on the account, region and team zones of a cluster are done once
+for all clusters sharing them, and the lookups and the encryption of the passwords are spread over a
+pool of worker threads. The definitions are rendered one after another, which is faster than
+starting worker processes for them unless the fleet is very large; --render-processes spreads
+the rendering over that many processes. Each definition is written to <name>.yaml.
+
+    $ spilo-fleet manifest.yaml --output-dir definitions
+'''
+
+import os
+import re
+from collections import OrderedDict
+
+import click
+import yaml
+from clickclick import fatal_error
+
+from acid.senza.templates.base import (DISCOVERY_CACHE_TTLS, DiscoveryError, apply_discovery_results,
+                                       generate_definitions, get_cluster_tasks, get_environment_key,
+                                       get_environment_tasks, get_spot_price_tasks, prepare_variables, run_discovery)
+
+FLEET_WORKERS = 8
+
+
+def read_manifest(manifest):
+    """
+        List of the (name, variables) of the clusters in the manifest
+
+    >>> read_manifest('{defaults: {team_region: eu-west-1}, clusters: [{name: a, team_name: x}]}')
+    [('a', {'team_region': 'eu-west-1', 'team_name': 'x'})]
+    """
+    data = yaml.safe_load(manifest) or {}
+    defaults = data.get('defaults') or {}
+    clusters = []
+    for entry in data.get('clusters') or []:
+        variables = dict(defaults)
+        variables.update(entry)
+        name = str(variables.pop('name', ''))
+        if not re.match(r'^[\w.-]+$', name):
+            fatal_error('Invalid cluster name "{0}": should consist of letters, digits, ".", "-" or "_"'.format(name))
+        if name in (n for n, _ in clusters):
+            fatal_error('Duplicate cluster name "{0}"'.format(name))
+        clusters.append((name, variables))
+    if not clusters:
+        fatal_error('No clusters defined in the manifest')
+    return clusters
+
+
+def gather_fleet_variables(clusters, workers=FLEET_WORKERS):
+    """
+        Same as gather_user_variables for every cluster, but with the environment lookups done
+        only once for all clusters with the same environment, and all lookups running concurrently.
+    """
+    environments = OrderedDict()
+    for name, variables in clusters:
+        region = variables.get('team_region')
+        prepare_variables(variables, region)
+        environments.setdefault(get_environment_key(variables), []).append((name, variables))
+
+    tasks = []
+    scopes = []
+    for number, members in enumerate(environments.values()):
+        environment_scope = 'environment:{0}/'.format(number)
+        region = members[0][1]['team_region']
+        tasks.extend(get_environment_tasks(members[0][1], region, environment_scope))
+        for name, variables in members:
+            scope = 'cluster:{0}/'.format(name)
+            tasks.extend(get_cluster_tasks(variables, region, scope, environment_scope))
+            scopes.append((variables, scope, environment_scope))
+        # the spot price history of all instance types of the environment is fetched at once
+        tasks.extend(get_spot_price_tasks([variables for _, variables in members], region, environment_scope))
+
+    try:
+        results = run_discovery(tasks, max_workers=workers)
+    except DiscoveryError as e:
+        fatal_error(str(e))
+
+    for variables, scope, environment_scope in scopes:
+        apply_discovery_results(variables, results, scope, environment_scope)
+    return clusters
+
+
+@click.command()
+@click.argument('manifest', type=click.File('r'))
+@click.option('--output-dir', '-o', default='.', type=click.Path(file_okay=False),
+              help='Directory to write the definitions to')
+@click.option('--workers', '-w', default=FLEET_WORKERS, type=int, help='Number of concurrent lookups in AWS and DNS')
+@click.option('--render-processes', default=0, type=int,
+              help='Number of processes to render the definitions in (default: render them in this process)')
+@click.option('--refresh', is_flag=True, help='Ignore the cached discovery results')
+@click.option('--invalidate', type=click.Choice(['all'] + sorted(DISCOVERY_CACHE_TTLS)),
+              help='Drop the cached discovery results of the kind, or of all kinds')
+def main(manifest, output_dir, workers, render_processes, refresh, invalidate):
+    """ Generate the Senza definitions of the Spilo clusters listed in the MANIFEST """
+    clusters = read_manifest(manifest.read())
+    for _, variables in clusters:
+        if refresh:
+            variables['refresh_cache'] = True
+        if invalidate:
+            variables['invalidate_cache'] = invalidate
+    clusters = gather_fleet_variables(clusters, workers)
+    definitions = generate_definitions([variables for _, variables in clusters], processes=render_processes)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for (name, _), definition in zip(clusters, definitions):
+        path = os.path.join(output_dir, name + '.yaml')
+        with open(path, 'w') as f:
+            f.write(definition)
+        click.echo(path)
+
+
+if __name__ == '__main__':
+    main()
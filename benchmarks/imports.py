@@ -0,0 +1,63 @@
+'''
+Check of the cost of importing the template module, which senza does whenever it lists or loads
+the templates, also for the commands that never use this one. Fails if the import takes longer
+than the budget, or if it pulls in any of the heavy dependencies that are only needed once the
+template is actually used.
+
+    $ python -m benchmarks.imports [--budget 75] [--repeat 5]
+'''
+
+import argparse
+import re
+import subprocess
+import sys
+
+MODULE = 'acid.senza.templates.base'
+IMPORT_BUDGET_MS = 75
+HEAVY_DEPENDENCIES = ('boto3', 'botocore', 'requests', 'urllib3', 'dns', 'clickclick', 'click', 'senza', 'pystache',
+                      'yaml', 'concurrent.futures', 'multiprocessing')
+
+
+def measure_import(module):
+    """ Cumulative import time of the module in a fresh interpreter in ms, and the modules it imported """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    # the modules imported by site (e.g. with .pth files) are not part of the cost of the module
+    lines = [line for line in output.splitlines() if line.startswith('import time:')]
+    start = max((i for i, line in enumerate(lines) if re.search(r'\|\s*site$', line)), default=-1) + 1
+    imported = []
+    cumulative = None
+    for line in lines[start:]:
+        _, _, name = line.rpartition('|')
+        imported.append(name.strip())
+        if name.strip() == module:
+            cumulative = int(line.split('|')[1]) / 1000
+    return cumulative, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS, help='maximum import time in ms')
+    parser.add_argument('--repeat', type=int, default=5, help='number of measurements, the fastest one counts')
+    args = parser.parse_args()
+
+    measurements = [measure_import(MODULE) for _ in range(args.repeat)]
+    elapsed = min(m[0] for m in measurements)
+    imported = measurements[0][1]
+    heavy = [dependency for dependency in HEAVY_DEPENDENCIES
+             if any(name == dependency or name.startswith(dependency + '.') for name in imported)]
+
+    print('import {0}: {1:.1f} ms (budget {2:.0f} ms), {3} modules'.format(
+        MODULE, elapsed, args.budget, len(imported)))
+    failed = False
+    if heavy:
+        print('heavy dependencies imported: {0}'.format(', '.join(heavy)))
+        failed = True
+    if elapsed > args.budget:
+        print('over the budget by {0:.1f} ms'.format(elapsed - args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+'''
+Benchmark of the whole template pipeline, from set_default_variables to get_on_demand_price,
+against the local stand-ins of AWS, DNS, the Docker registry and the pricing API. Reports the
+wall time, the peak RSS and the calls to each service for every stage, for a cold run (empty
+caches) and a warm one, and optionally how the stages scale with the size of the hosted zone,
+the number of security groups and the number of CIDRs allowed to access the cluster.
+
+    $ python -m benchmarks.pipeline [--offer-products 100000] [--aws-latency 0.02] [--sweep] [--output results.json]
+'''
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+from acid.senza.templates import _aws, _dns, _replay, base
+from benchmarks import standins
+
+REGION = 'eu-west-1'
+TEAM_ZONE = 'team.example.com.'
+HOSTED_ZONE = 'db.example.com.'
+INSTANCE_TYPE = 'x0.1xlarge'  # the first instance type of the synthetic offer file
+POSTGRESQL_PARAMETERS = 20
+
+ZONE_SIZES = (100, 1000, 10000, 100000)
+SG_COUNTS = (10, 100, 1000, 10000)
+CIDR_COUNTS = (10, 100, 1000, 10000)
+
+Region = namedtuple('Region', 'Region')
+Result = namedtuple('Result', 'stage seconds peak_rss calls')
+
+
+class Environment:
+    """ Stand-ins of all the services, and the template set up to use them instead of the real ones """
+
+    def __init__(self, directory, offer_products, zone_size=100, sg_count=100, aws_latency=0.0):
+        self.directory = directory
+        self.aws = standins.FakeAWS(HOSTED_ZONE, REGION, zone_size, sg_count, aws_latency)
+
+        records = {'odd-{0}.{1}'.format(region, TEAM_ZONE): ['172.31.{0}.10'.format(number)]
+                   for number, region in enumerate(base.TEAM_REGIONS)}
+        for number, region in enumerate(base.TEAM_REGIONS):
+            for az in base.TEAM_AVAILABILITY_ZONES:
+                records['nat-{0}{1}.{2}'.format(region, az, TEAM_ZONE)] = ['52.{0}.{1}.1'.format(number, ord(az))]
+        for i in range(zone_size):
+            records['host{0:06d}.{1}'.format(i, TEAM_ZONE)] = ['10.2.{0}.{1}'.format(i // 256 % 256, i % 256)]
+        self.dns = standins.start(standins.DNSServer(records))
+
+        files = {}
+        if offer_products:
+            offer_file = os.path.join(directory, 'offer-{0}.json'.format(offer_products))
+            if not os.path.exists(offer_file):
+                standins.write_offer_file(offer_file, offer_products)
+            files['/offers/index.json'] = offer_file
+        tags_file = os.path.join(directory, 'tags.json')
+        standins.write_registry_tags(tags_file)
+        files['/teams/acid/artifacts/spilo-9.5/tags'] = tags_file
+        self.http = standins.start(standins.HTTPServer(files))
+
+        self.cache_dir = tempfile.mkdtemp(dir=directory)
+
+    def close(self):
+        self.dns.shutdown()
+        self.dns.server_close()
+        self.http.shutdown()
+        self.http.server_close()
+
+    def install(self):
+        """ Point the template at the stand-ins, dropping everything it keeps in memory """
+        os.environ['SPILO_CACHE_DIR'] = self.cache_dir
+        base.PRICE_URL = self.http.url + '/offers/index.json'
+        base.REGISTRY_TAGS_URL = self.http.url + '/teams/{team}/artifacts/{artifact}/tags'
+        base._price_index = None
+        base._hosted_zone_ids.clear()
+        base._discovery_caches.clear()
+        _aws._clients.clear()
+        for service, region in (('route53', None), ('iam', None), ('sts', None),
+                                ('ec2', REGION), ('kms', REGION), ('s3', REGION)):
+            _aws._clients[(service, region)] = self.aws.client(service, region)
+        _dns._resolver = _dns.CachingResolver(nameservers=['127.0.0.1'], port=self.dns.port)
+
+    def counters(self):
+        counters = Counter(self.aws.calls)
+        counters['dns'] = self.dns.queries
+        counters['http'] = self.http.requests
+        counters['http.bytes'] = self.http.bytes_sent
+        return counters
+
+
+def reset_peak_rss():
+    """ Reset the peak RSS of the process, supported on Linux only """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    """ Peak RSS of the process in bytes, since the last reset_peak_rss where supported """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(environment, stage, function, *args):
+    reset_peak_rss()
+    before = environment.counters()
+    started = time.perf_counter()
+    function(*args)
+    seconds = time.perf_counter() - started
+    calls = environment.counters()
+    calls.subtract(before)
+    return Result(stage, seconds, get_peak_rss(), OrderedDict(sorted((k, v) for k, v in calls.items() if v)))
+
+
+def sample_variables():
+    return {
+        'team_name': 'acid',
+        'team_region': REGION,
+        'team_gateway_zone': TEAM_ZONE,
+        'hosted_zone': HOSTED_ZONE,
+        'instance_type': INSTANCE_TYPE,
+    }
+
+
+def sample_postgresql_configuration(count=POSTGRESQL_PARAMETERS):
+    return '{' + ', '.join('parameter_{0}: {1}MB'.format(i, i * 16) for i in range(count)) + '}'
+
+
+def sample_addresses(count):
+    return ['10.{0}.{1}.{2}'.format(i // 65536 % 256, i // 256 % 256, i % 256) for i in range(count)]
+
+
+def run_pipeline(environment, cidr_count=16):
+    """ Run all stages of the pipeline, each with its inputs prepared by the previous ones """
+    environment.install()
+    variables = sample_variables()
+    addresses = sample_addresses(cidr_count)
+    conf = sample_postgresql_configuration()
+    return [
+        measure(environment, 'set_default_variables', base.set_default_variables, variables),
+        measure(environment, 'gather_user_variables', base.gather_user_variables, variables, None, Region(REGION)),
+        measure(environment, 'generate_spilo_master_security_group_ingress',
+                base.generate_spilo_master_security_group_ingress, addresses),
+        measure(environment, 'generate_postgresql_configuration', base.generate_postgresql_configuration, conf),
+        measure(environment, 'generate_definition', base.generate_definition, variables),
+        measure(environment, 'get_on_demand_price', base.get_on_demand_price, base.DeferredAction(), REGION,
+                INSTANCE_TYPE),
+    ]
+
+
+def format_calls(calls):
+    return ' '.join('{0}={1}'.format(k, v) for k, v in calls.items())
+
+
+def print_results(title, results):
+    print(title)
+    for r in results:
+        print('  {0:<46} {1:10.2f} ms {2:8.1f} MB  {3}'.format(r.stage, r.seconds * 1000, r.peak_rss / 2 ** 20,
+                                                               format_calls(r.calls)))
+
+
+def sweep(name, values, create_environment, run_stage):
+    """ Run the stage in a new environment for each value of the parameter, return the results """
+    results = []
+    for value in values:
+        environment = create_environment(value)
+        try:
+            environment.install()
+            result = run_stage(environment, value)
+        finally:
+            environment.close()
+        print('  {0:<12} {1:>8} {2:10.2f} ms {3:8.1f} MB  {4}'.format(
+            name, value, result.seconds * 1000, result.peak_rss / 2 ** 20, format_calls(result.calls)))
+        results.append((value, result))
+    return results
+
+
+def gather_stage(environment, value):
+    return measure(environment, 'gather_user_variables', base.gather_user_variables, sample_variables(), None,
+                   Region(REGION))
+
+
+def ingress_stage(environment, value):
+    return measure(environment, 'generate_spilo_master_security_group_ingress',
+                   base.generate_spilo_master_security_group_ingress, sample_addresses(value))
+
+
+def run_sweeps(directory, aws_latency):
+    results = OrderedDict()
+    print('gather_user_variables by the number of records in the hosted zones')
+    results['zone_size'] = sweep('zone_size', ZONE_SIZES, lambda value: Environment(
+        directory, 0, zone_size=value, aws_latency=aws_latency), gather_stage)
+    print('gather_user_variables by the number of security groups')
+    results['sg_count'] = sweep('sg_count', SG_COUNTS, lambda value: Environment(
+        directory, 0, sg_count=value, aws_latency=aws_latency), gather_stage)
+    print('generate_spilo_master_security_group_ingress by the number of CIDRs')
+    results['cidr_count'] = sweep('cidr_count', CIDR_COUNTS, lambda value: Environment(directory, 0), ingress_stage)
+    return results
+
+
+def to_json(results):
+    return [dict(r._asdict()) for r in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--offer-products', type=int, default=100000,
+                        help='number of products in the synthetic offer file (the real one has several 100000s)')
+    parser.add_argument('--aws-latency', type=float, default=0.0, help='latency of every AWS API call, in seconds')
+    parser.add_argument('--sweep', action='store_true', help='measure the scaling with the size of the inputs')
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    args = parser.parse_args()
+
+    # the stand-ins replace the AWS credentials, the snapshots and the proxies of the environment
+    for name in ('SPILO_RECORD', 'SPILO_REPLAY', 'SPILO_PRICE_INDEX_TTL', 'http_proxy', 'HTTP_PROXY'):
+        os.environ.pop(name, None)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ['no_proxy'] = '127.0.0.1'
+    _replay.set_snapshot(None)
+
+    directory = tempfile.mkdtemp(prefix='spilo-benchmark-')
+    output = {}
+    try:
+        started = time.perf_counter()
+        environment = Environment(directory, args.offer_products, aws_latency=args.aws_latency)
+        print('synthetic offer file: {0} products, {1:.1f} MB, written in {2:.1f} s'.format(
+            args.offer_products, os.path.getsize(environment.http.files['/offers/index.json']) / 2 ** 20,
+            time.perf_counter() - started))
+        try:
+            cold = run_pipeline(environment)
+            print_results('cold run (empty caches)', cold)
+            warm = run_pipeline(environment)
+            print_results('warm run (discovery cache, price index and registry tags on disk)', warm)
+        finally:
+            environment.close()
+        output['cold'] = to_json(cold)
+        output['warm'] = to_json(warm)
+
+        if args.sweep:
+            sweeps = run_sweeps(directory, args.aws_latency)
+            output['sweeps'] = {name: [dict(value=value, **r._asdict()) for value, r in results]
+                                for name, results in sweeps.items()}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
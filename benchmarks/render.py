@@ -0,0 +1,90 @@
+'''
+Benchmark of rendering the Senza definition, comparing the rendering from the template
+source on every call with the rendering of the parsed template, one by one and in batches.
+
+    $ python -m benchmarks.render [--count 500] [--processes 4] [--repeat 3]
+'''
+
+import argparse
+import time
+
+from senza.utils import pystache_render
+
+from acid.senza.templates import base
+
+
+def sample_variables(number):
+    """ Variables of a cluster as they are after gather_user_variables, without any lookups """
+    rules = base.generate_spilo_master_security_group_ingress(['10.0.{0}.{1}'.format(number % 256, i * 2)
+                                                               for i in range(8)])
+    variables = {
+        'version': 'cluster{0}'.format(number),
+        'team_name': 'team{0}'.format(number % 10),
+        'team_region': 'eu-west-1',
+        'team_gateway_zone': 'team.example.com.',
+        'hosted_zone': 'db.example.com.',
+        'docker_image': base.SPILO_IMAGE_ADDRESS + ':1.0-p1',
+        'discovery_domain': 'west.db.example.com',
+        'wal_s3_bucket': 'account-eu-west-1-spilo-dbaas',
+        'kms_arn': 'arn:aws:kms:eu-west-1:123456789012:key/00000000-0000-0000-0000-000000000000',
+        'odd_sg_id': 'sg-00000001',
+        'zmon_sg_id': 'sg-00000002',
+        'add_replica_loadbalancer': number % 2 == 0,
+        'postgresql_parameters': base.parse_postgresql_configuration('{shared_buffers: 1GB, work_mem: 16MB}'),
+        'spilo_master_security_groups': base.plan_security_groups('SpiloMasterSG', rules),
+        'spilo_replica_security_groups': base.plan_security_groups('SpiloReplicaSG', rules),
+    }
+    variables['postgresqlconf'] = base.format_postgresql_parameters(variables['postgresql_parameters'])
+    for name in ('pgpassword_admin', 'pgpassword_standby', 'pgpassword_superuser'):
+        variables[name] = 'aws:kms:' + base.generate_random_password()
+    # supply every variable with a default, so that set_default_variables and its lookups are not needed
+    defaults = {
+        'add_replica_loadbalancer': False, 'master_dns_name': None, 'replica_dns_name': None, 'ldap_url': None,
+        'ldap_suffix': None, 'ebs_optimized': False, 'fsoptions': 'noatime,nodiratime,nobarrier', 'fstype': 'ext4',
+        'healthcheck_port': base.HEALTHCHECK_PORT, 'postgres_port': base.POSTGRES_PORT, 'instance_type': 'm4.large',
+        'number_of_instances': 3, 'promotheus_port': '9100', 'snapshot_id': None, 'volume_iops': None,
+        'volume_size': 50, 'volume_type': 'gp2', 'use_spot_instances': False, 'spot_price': 0, 'use_ebs': True,
+        'raid_device': None, 'data_partition': '/dev/xvdk',
+        'block_devices': base.get_block_devices(True, 'm4.large', 1, 50, 'gp2', None),
+        'use_pooler': False, 'pooler_port': base.POOLER_PORT, 'instance_port': base.POSTGRES_PORT,
+        'pooler_settings': [], 'availability_profile': 'default', 'availability': base.get_availability('default'),
+    }
+    for name, value in defaults.items():
+        variables.setdefault(name, value)
+    return variables
+
+
+def measure(name, function, count, repeat=1):
+    """ The fastest of repeat runs of the function, which renders count definitions """
+    elapsed = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = min(elapsed, time.perf_counter() - started)
+    print('{0:<40} {1:10.3f} ms/definition'.format(name, elapsed * 1000 / count))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=500, help='number of definitions to render')
+    parser.add_argument('--processes', type=int, default=4, help='number of processes for the batch rendering')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each way, the fastest one counts')
+    args = parser.parse_args()
+
+    variable_sets = [sample_variables(i) for i in range(args.count)]
+    # the outputs must be the same, whichever way they are rendered
+    assert pystache_render(base.TEMPLATE, variable_sets[0]) == base.generate_definition(variable_sets[0])
+
+    before = measure('template source on every call', lambda: [pystache_render(base.TEMPLATE, v)
+                                                               for v in variable_sets], args.count, args.repeat)
+    after = measure('parsed template', lambda: [base.generate_definition(v) for v in variable_sets], args.count,
+                    args.repeat)
+    measure('parsed template, batch', lambda: base.generate_definitions(variable_sets), args.count, args.repeat)
+    measure('parsed template, {0} processes'.format(args.processes),
+            lambda: base.generate_definitions(variable_sets, args.processes), args.count)
+    print('speedup of the parsed template: {0:.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Benchmark of the spot bid calculation: loading the spot price history of many instance types
+at once from the EC2 stand-in, and the analysis of the history of each of them, for a number
+of days of history with a price change every hour in every availability zone.
+
+    $ python -m benchmarks.spot [--instance-types 20] [--days 90] [--zones 3] [--percentile 90]
+'''
+
+import argparse
+import datetime
+import time
+
+from acid.senza.templates import _spot
+from benchmarks import standins
+
+REGION = 'eu-west-1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--instance-types', type=int, default=20, help='number of instance types')
+    parser.add_argument('--days', type=int, default=90, help='days of history')
+    parser.add_argument('--zones', type=int, default=3, help='number of availability zones')
+    parser.add_argument('--percentile', type=float, default=90, help='percentile of the price to bid')
+    args = parser.parse_args()
+
+    instance_types = ['x{0}.large'.format(i) for i in range(args.instance_types)]
+    zones = [REGION + chr(ord('a') + i) for i in range(args.zones)]
+    end = datetime.datetime.now(datetime.timezone.utc)
+    start = end - datetime.timedelta(days=args.days)
+    aws = standins.FakeAWS('db.example.com.', REGION)
+    aws.spot_price_history = standins.generate_spot_price_history(instance_types, zones, args.days, end=end)
+    ec2 = aws.client('ec2', REGION)
+    # the stand-in filters the records on the first call, which is not part of the measurement
+    ec2.describe_spot_price_history(InstanceTypes=sorted(instance_types),
+                                    ProductDescriptions=_spot.PRODUCT_DESCRIPTIONS)
+
+    started = time.perf_counter()
+    histories = _spot.load_spot_price_history(ec2, instance_types, start, end)
+    loaded = time.perf_counter()
+    analyses = [_spot.analyze_spot_prices(histories[t], start.timestamp(), end.timestamp(), args.percentile)
+                for t in instance_types]
+    analyzed = time.perf_counter()
+
+    records = sum(len(h) for h in histories.values())
+    print('{0} records of {1} instance types in {2} zones over {3} days, {4} pages'.format(
+        records, args.instance_types, args.zones, args.days, aws.calls['ec2.describe_spot_price_history'] - 1))
+    print('load:     {0:8.1f} ms'.format((loaded - started) * 1000))
+    print('analysis: {0:8.1f} ms, {1:.2f} ms per instance type'.format(
+        (analyzed - loaded) * 1000, (analyzed - loaded) * 1000 / len(instance_types)))
+    first = analyses[0]
+    print('{0}: bid {1:.4f} at the {2:g}th percentile'.format(instance_types[0], first.bid, args.percentile))
+    for s in first.series:
+        print('  {0}: mean {1:.4f}, volatility {2:.2f}, maximum {3:.4f}, interruption risk {4:.1%}, '
+              '{5:.2f} interruptions a day'.format(s.zone, s.mean, s.volatility, s.maximum,
+                                                   s.interruption_risk, s.interruptions_per_day))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+'''
+Local stand-ins for the services used by the template, for the benchmarks: AWS API clients
+(Route53, EC2, KMS, S3, IAM, STS) in memory, a DNS server and an HTTP server on the loopback
+interface. Every stand-in counts the calls it serves.
+'''
+
+import bisect
+import datetime
+import fnmatch
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dns.message
+import dns.rcode
+import dns.rrset
+
+ACCOUNT_ID = '123456789012'
+ACCOUNT_ALIAS = 'benchmark'
+ROUTE53_PAGE_SIZE = 300
+EC2_PAGE_SIZE = 1000
+KMS_PAGE_SIZE = 100
+DNS_TTL = 300
+
+
+class FakeAWS:
+    """
+        In-memory AWS account with a DBaaS hosted zone of zone_size records and sg_count security
+        groups besides the odd and zmon ones. Every API call sleeps for latency seconds.
+    """
+
+    def __init__(self, hosted_zone, region, zone_size=100, sg_count=100, latency=0.0):
+        self.calls = Counter()
+        self.latency = latency
+        self.hosted_zone = hosted_zone
+        etcd_name = '_etcd._tcp.{0}.{1}'.format(region.split('-')[1], hosted_zone)
+        records = [{'Name': 'host{0:06d}.{1}'.format(i, hosted_zone), 'Type': 'A', 'TTL': 300,
+                    'ResourceRecords': [{'Value': '10.1.{0}.{1}'.format(i // 256 % 256, i % 256)}]}
+                   for i in range(zone_size)]
+        records.append({'Name': etcd_name, 'Type': 'SRV', 'TTL': 300,
+                        'ResourceRecords': [{'Value': '0 0 2379 etcd.{0}'.format(hosted_zone)}]})
+        self.records = sorted(records, key=lambda r: (r['Name'], r['Type']))
+        self.record_keys = [(r['Name'], r['Type']) for r in self.records]
+        self.security_groups = [{'GroupName': 'Odd (SSH Bastion Host)', 'GroupId': 'sg-0dd00000'},
+                                {'GroupName': 'app-zmon-db', 'GroupId': 'sg-2a0a0000'}]
+        self.security_groups += [{'GroupName': 'app-service-{0}'.format(i), 'GroupId': 'sg-{0:08x}'.format(i)}
+                                 for i in range(sg_count)]
+        # records of describe_spot_price_history, newest first, see generate_spot_price_history
+        self.spot_price_history = []
+        self._spot_price_queries = {}
+        self.kms_keys = [{'KeyId': 'key-{0}'.format(i), 'Arn': 'arn:aws:kms:{0}:{1}:key/key-{2}'.format(
+            region, ACCOUNT_ID, i), 'Description': 'spilo' if i == 3 else 'key {0}'.format(i)} for i in range(5)]
+
+    def call(self, service, operation):
+        self.calls['{0}.{1}'.format(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def client(self, service, region=None):
+        return {'route53': FakeRoute53, 'ec2': FakeEC2, 'kms': FakeKMS, 's3': FakeS3,
+                'iam': FakeIAM, 'sts': FakeSTS}[service](self)
+
+
+class FakeClient:
+    # operation: (input token, output token)
+    pagination = {}
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def can_paginate(self, operation):
+        return operation in self.pagination
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+
+class FakePaginator:
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        input_token, output_token = self.client.pagination[self.operation]
+        while True:
+            page = getattr(self.client, self.operation)(**kwargs)
+            yield page
+            if not page.get(output_token):
+                return
+            kwargs[input_token] = page[output_token]
+
+
+class FakeRoute53(FakeClient):
+
+    def list_hosted_zones_by_name(self, DNSName=None, MaxItems='100'):
+        self.aws.call('route53', 'list_hosted_zones_by_name')
+        return {'HostedZones': [{'Id': '/hostedzone/ZBENCHMARK', 'Name': self.aws.hosted_zone}], 'IsTruncated': False}
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None, StartRecordType=None,
+                                  StartRecordIdentifier=None, MaxItems=str(ROUTE53_PAGE_SIZE)):
+        self.aws.call('route53', 'list_resource_record_sets')
+        records = self.aws.records
+        start = bisect.bisect_left(self.aws.record_keys, (StartRecordName, StartRecordType or '')) \
+            if StartRecordName else 0
+        end = start + int(MaxItems)
+        response = {'ResourceRecordSets': records[start:end], 'IsTruncated': end < len(records)}
+        if response['IsTruncated']:
+            response['NextRecordName'] = records[end]['Name']
+            response['NextRecordType'] = records[end]['Type']
+        return response
+
+
+class FakeEC2(FakeClient):
+    pagination = {'describe_security_groups': ('NextToken', 'NextToken'),
+                  'describe_spot_price_history': ('NextToken', 'NextToken')}
+
+    def describe_security_groups(self, Filters=(), NextToken=None, MaxResults=EC2_PAGE_SIZE):
+        self.aws.call('ec2', 'describe_security_groups')
+        groups = self.aws.security_groups
+        for f in Filters:
+            if f['Name'] == 'group-name':
+                groups = [g for g in groups if any(fnmatch.fnmatchcase(g['GroupName'], v) for v in f['Values'])]
+        start = int(NextToken or 0)
+        response = {'SecurityGroups': groups[start:start + MaxResults]}
+        if start + MaxResults < len(groups):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def describe_spot_price_history(self, InstanceTypes=(), ProductDescriptions=(), StartTime=None, EndTime=None,
+                                    NextToken=None, PaginationConfig=None, MaxResults=EC2_PAGE_SIZE):
+        self.aws.call('ec2', 'describe_spot_price_history')
+        if PaginationConfig:
+            MaxResults = PaginationConfig.get('PageSize', MaxResults)
+        key = (tuple(InstanceTypes), tuple(ProductDescriptions), len(self.aws.spot_price_history))
+        records = self.aws._spot_price_queries.get(key)
+        if records is None:
+            records = self.aws._spot_price_queries[key] = [
+                r for r in self.aws.spot_price_history
+                if r['InstanceType'] in InstanceTypes and r['ProductDescription'] in ProductDescriptions]
+        start = int(NextToken or 0)
+        response = {'SpotPriceHistory': records[start:start + MaxResults]}
+        if start + MaxResults < len(records):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+
+class FakeKMS(FakeClient):
+    pagination = {'list_keys': ('Marker', 'NextMarker'), 'list_aliases': ('Marker', 'NextMarker')}
+
+    def _page(self, operation, items, result_key, Marker=None):
+        self.aws.call('kms', operation)
+        start = int(Marker or 0)
+        response = {result_key: items[start:start + KMS_PAGE_SIZE], 'Truncated': start + KMS_PAGE_SIZE < len(items)}
+        if response['Truncated']:
+            response['NextMarker'] = str(start + KMS_PAGE_SIZE)
+        return response
+
+    def list_keys(self, Marker=None):
+        return self._page('list_keys', [{'KeyId': k['KeyId'], 'KeyArn': k['Arn']} for k in self.aws.kms_keys],
+                          'Keys', Marker)
+
+    def list_aliases(self, Marker=None):
+        return self._page('list_aliases', [{'AliasName': 'alias/' + k['KeyId'], 'TargetKeyId': k['KeyId']}
+                                           for k in self.aws.kms_keys], 'Aliases', Marker)
+
+    def describe_key(self, KeyId):
+        self.aws.call('kms', 'describe_key')
+        return {'KeyMetadata': dict(next(k for k in self.aws.kms_keys if k['KeyId'] == KeyId))}
+
+    def encrypt(self, KeyId, Plaintext):
+        self.aws.call('kms', 'encrypt')
+        data = Plaintext.encode('utf-8') if isinstance(Plaintext, str) else Plaintext
+        return {'KeyId': KeyId, 'CiphertextBlob': b'\x01\x02\x03' + bytes(reversed(data))}
+
+
+class FakeS3(FakeClient):
+
+    def head_bucket(self, Bucket):
+        self.aws.call('s3', 'head_bucket')
+        return {}
+
+    def create_bucket(self, **kwargs):
+        self.aws.call('s3', 'create_bucket')
+        return {}
+
+
+class FakeIAM(FakeClient):
+
+    def list_account_aliases(self):
+        self.aws.call('iam', 'list_account_aliases')
+        return {'AccountAliases': [ACCOUNT_ALIAS]}
+
+
+class FakeSTS(FakeClient):
+
+    def get_caller_identity(self):
+        self.aws.call('sts', 'get_caller_identity')
+        return {'Account': ACCOUNT_ID}
+
+
+class DNSServer(socketserver.ThreadingUDPServer):
+    """ Authoritative DNS server on the loopback interface, answering A queries from the records dictionary """
+
+    daemon_threads = True
+
+    def __init__(self, records):
+        super().__init__(('127.0.0.1', 0), DNSHandler)
+        self.records = records
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class DNSHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        with self.server._lock:
+            self.server.queries += 1
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        addresses = self.server.records.get(question.name.to_text().lower())
+        if addresses:
+            response.answer.append(dns.rrset.from_text_list(question.name, DNS_TTL, 'IN', 'A', addresses))
+        else:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class HTTPServer(ThreadingHTTPServer):
+    """ HTTP server on the loopback interface, serving the files in the dictionary of path -> file name """
+
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(('127.0.0.1', 0), HTTPHandler)
+        self.files = files
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # the price index stops reading the offer file once it has all on-demand terms, and closes the connection
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server._lock:
+            self.server.requests += 1
+        path = self.server.files.get(self.path)
+        if path is None:
+            self.send_error(404)
+            return
+        stat = os.stat(path)
+        etag = '"{0}-{1}"'.format(stat.st_size, int(stat.st_mtime))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(stat.st_size))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                with self.server._lock:
+                    self.server.bytes_sent += len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(server):
+    """ Serve in a background thread, return the server """
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_offer_file(path, products, locations=('EU (Ireland)', 'EU (Frankfurt)', 'US East (N. Virginia)')):
+    """
+        Write a synthetic EC2 offer file in the format of the AWS pricing API, with the given
+        number of products, most of them compute instances, and their on-demand and reserved terms
+    """
+    operating_systems = ('Linux', 'Windows', 'RHEL', 'SUSE')
+    tenancies = ('Shared', 'Dedicated', 'Host')
+
+    def product(i):
+        sku = 'SKU{0:012d}'.format(i)
+        family = 'Storage' if i % 10 == 9 else 'Compute Instance'
+        attributes = {
+            'servicecode': 'AmazonEC2', 'location': locations[i % len(locations)], 'locationType': 'AWS Region',
+            'instanceType': 'x{0}.{1}xlarge'.format(i // 48 % 1000, i // 48000 + 1),
+            'currentGeneration': 'Yes', 'instanceFamily': 'General purpose', 'vcpu': str(2 ** (i % 6)),
+            'physicalProcessor': 'Intel Xeon E5-2676 v3 (Haswell)', 'clockSpeed': '2.4 GHz', 'memory': '8 GiB',
+            'storage': 'EBS only', 'networkPerformance': 'Moderate', 'processorArchitecture': '64-bit',
+            'tenancy': tenancies[i // 3 % len(tenancies)], 'operatingSystem': operating_systems[i // 9 % 4],
+            'licenseModel': 'No License required', 'usagetype': 'BoxUsage', 'operation': 'RunInstances',
+            'dedicatedEbsThroughput': '450 Mbps', 'enhancedNetworkingSupported': 'Yes', 'preInstalledSw': 'NA',
+        }
+        return sku, {'sku': sku, 'productFamily': family, 'attributes': attributes}
+
+    def terms(sku, i, term_type):
+        offer = '{0}.{1}'.format(sku, 'JRTCKXETXF' if term_type == 'OnDemand' else '4NA7Y494T4')
+        dimension = offer + '.6YS6EN2CT7'
+        return {offer: {'offerTermCode': offer.split('.')[1], 'sku': sku, 'effectiveDate': '2017-04-01T00:00:00Z',
+                        'priceDimensions': {dimension: {
+                            'rateCode': dimension, 'description': '${0:.3f} per On Demand Linux hour'.format(i / 1000),
+                            'beginRange': '0', 'endRange': 'Inf', 'unit': 'Hrs',
+                            'pricePerUnit': {'USD': '{0:.10f}'.format(0.01 + i % 5000 / 1000)}, 'appliesTo': []}},
+                        'termAttributes': {}}}
+
+    with open(path, 'w') as f:
+        f.write('{\n  "formatVersion" : "v1.0",\n  "offerCode" : "AmazonEC2",\n  "products" : {\n')
+        for i in range(products):
+            sku, value = product(i)
+            f.write('{0}    {1} : {2}'.format(',\n' if i else '', json.dumps(sku), json.dumps(value, indent=6)))
+        f.write('\n  },\n  "terms" : {\n')
+        for number, term_type in enumerate(('OnDemand', 'Reserved')):
+            f.write('{0}    "{1}" : {{\n'.format(',\n' if number else '', term_type))
+            for i in range(products):
+                sku = product(i)[0]
+                f.write('{0}      {1} : {2}'.format(',\n' if i else '', json.dumps(sku),
+                                                    json.dumps(terms(sku, i, term_type), indent=8)))
+            f.write('\n    }')
+        f.write('\n  }\n}\n')
+
+
+def write_registry_tags(path, count=200):
+    """ Write a synthetic tag list of the Docker registry, with a snapshot as the latest tag """
+    tags = [{'name': '1.0-p{0}'.format(i), 'created': '2017-01-01T00:{0:02d}:{1:02d}.000Z'.format(i // 60 % 60, i % 60)}
+            for i in range(count)]
+    tags.append({'name': '1.0-SNAPSHOT', 'created': '2017-12-31T00:00:00.000Z'})
+    with open(path, 'w') as f:
+        json.dump(tags, f)
+
+
+def generate_spot_price_history(instance_types, zones, days, changes_per_day=24, end=None, seed=0):
+    """
+        Synthetic records of describe_spot_price_history, newest first: a price change in every zone
+        changes_per_day times a day, mostly around a fifth of a base price, with occasional spikes
+    """
+    rng = random.Random(seed)
+    end = end or datetime.datetime.now(datetime.timezone.utc)
+    interval = datetime.timedelta(days=1) / changes_per_day
+    records = []
+    for number, instance_type in enumerate(instance_types):
+        base_price = 0.05 * (number % 8 + 1)
+        for zone in zones:
+            for step in range(days * changes_per_day):
+                spike = rng.random() < 0.01
+                price = base_price * (rng.uniform(1, 10) if spike else rng.uniform(0.15, 0.3))
+                records.append({'InstanceType': instance_type, 'AvailabilityZone': zone,
+                                'ProductDescription': 'Linux/UNIX', 'SpotPrice': '{0:.6f}'.format(price),
+                                'Timestamp': end - interval * step})
+    records.sort(key=lambda r: r['Timestamp'], reverse=True)
+    return records
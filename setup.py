@@ -73,7 +73,9 @@ def setup_packages():
         long_description=read('README.rst'),
         entry_points={
             'senza.templates':
-                ['base=acid.senza.templates.base']
+                ['base=acid.senza.templates.base'],
+            'console_scripts':
+                ['spilo-fleet=acid.senza.templates.fleet:main']
         }
     )
 